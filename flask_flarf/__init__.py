@@ -1,3 +1,15 @@
 __version__ = '0.0.6'
 
-from .flarf import Flarf, FlarfFilter, fs
+from .flarf import Flarf, FlarfFilter, FlarfParam, FlarfResult, fs
+from .cache import FlarfCache, FlarfSqliteCache
+from .matcher import FlarfMatcher
+from .graph import FlarfGraph
+from .stats import FlarfHistogram, FlarfStats
+from .pool import FlarfPool
+from .sampling import FlarfSampler, FlarfSkipped
+from .breaker import FlarfBreaker, FlarfBreakerOpen
+from .defer import FlarfQueue, FlarfSnapshot
+from .middleware import FlarfMiddleware
+from .replay import FlarfReplay
+from .admission import FlarfLimits, FlarfSharedLimits
+from .filters import FlarfAdmissionFilter, FlarfCacheFilter, FlarfConditionalFilter
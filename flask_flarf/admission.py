@@ -0,0 +1,173 @@
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+from contextlib import contextmanager
+from .cache import _now
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FlarfLimits(object):
+    """
+    In flight counts and token buckets keyed on route, shared by the threads
+    of a process.
+
+    The state of a key is [in flight, tokens, time of the last refill];
+    subclasses keep it elsewhere by overriding locked, read and write.
+    """
+    clock = staticmethod(_now)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = {}
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            yield
+
+    def read(self, key):
+        """The state of key, must be called within locked"""
+        return list(self.state.get(key, (0, None, None)))
+
+    def write(self, key, state):
+        """Must be called within locked"""
+        self.state[key] = state
+
+    def acquire(self, key, limit):
+        """Counts a request in flight on key, False if limit already are"""
+        with self.locked():
+            state = self.read(key)
+            if state[0] >= limit:
+                return False
+            state[0] += 1
+            self.write(key, state)
+            return True
+
+    def release(self, key):
+        with self.locked():
+            state = self.read(key)
+            state[0] = max(0, state[0] - 1)
+            self.write(key, state)
+
+    def take(self, key, rate, burst):
+        """
+        Takes a token from the bucket of key, refilled at rate per second up
+        to burst. Returns 0 when taken, else the seconds until one is due.
+        """
+        now = self.clock()
+        with self.locked():
+            state = self.read(key)
+            tokens, stamp = state[1], state[2]
+            if tokens is None:
+                tokens = burst
+            else:
+                tokens = min(burst, tokens + max(0, now - stamp) * rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / float(rate)
+            state[1], state[2] = tokens, now
+            self.write(key, state)
+            return wait
+
+    def inflight(self, key):
+        with self.locked():
+            return self.read(key)[0]
+
+
+_slot = struct.Struct('<Qqdd')
+
+
+class FlarfSharedLimits(FlarfLimits):
+    """
+    FlarfLimits in a memory mapped file, shared by the worker processes of a
+    server as well as their threads. Keys are hashed into a fixed number of
+    slots, updates are serialized with an exclusive lock on the file. When
+    every slot is taken, a new key takes the slot of the key idle longest,
+    one with nothing in flight and not updated for idle seconds.
+
+    :param path:                The counter file, created if missing. Remove
+                                it when (re)starting the server: the in flight
+                                counts of a worker killed mid request are
+                                never released
+    :param slots:               The most keys kept, defaults to 256
+    :param idle:                Seconds after which the slot of a key with
+                                nothing in flight may be taken, defaults to 60
+
+    The file is mapped on first use, and again in a forked child, so it may
+    be created before a server forks its workers. Requires fcntl (POSIX).
+    """
+    clock = staticmethod(time.time)
+
+    def __init__(self, path, slots=256, idle=60):
+        if fcntl is None:
+            raise RuntimeError('FlarfSharedLimits requires fcntl')
+        super(FlarfSharedLimits, self).__init__()
+        self.path = path
+        self.slots = slots
+        self.idle = idle
+        self.fd = None
+        self.map = None
+        self.pid = None
+
+    def open(self):
+        if self.pid != os.getpid():
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            size = _slot.size * self.slots
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.fd, self.map, self.pid = fd, mmap.mmap(fd, size), os.getpid()
+
+    @contextmanager
+    def locked(self):
+        with self.lock:
+            self.open()
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def key_hash(self, key):
+        digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] or 1
+
+    def find(self, key):
+        """
+        (slot offset, stored hash) of key, probing from its hash, with a
+        stored hash of 0 for a free or reclaimed slot
+        """
+        h = self.key_hash(key)
+        oldest, reclaim = self.clock() - self.idle, None
+        for i in range(self.slots):
+            offset = ((h + i) % self.slots) * _slot.size
+            stored, inflight, tokens, stamp = _slot.unpack_from(self.map, offset)
+            if stored in (h, 0):
+                return offset, stored
+            if not inflight and stamp <= oldest:
+                oldest, reclaim = stamp, offset
+        if reclaim is None:
+            raise RuntimeError('FlarfSharedLimits {} has no free slot'.format(self.path))
+        # an idle key reads as new, so its slot is taken without a tombstone
+        return reclaim, 0
+
+    def read(self, key):
+        offset, stored = self.find(key)
+        if not stored:
+            return [0, None, None]
+        inflight, tokens, stamp = _slot.unpack_from(self.map, offset)[1:]
+        return [inflight, None if stamp == 0 else tokens, stamp]
+
+    def write(self, key, state):
+        offset, stored = self.find(key)
+        inflight, tokens, stamp = state
+        _slot.pack_into(self.map, offset, self.key_hash(key), inflight,
+                        tokens or 0.0, stamp or 0.0)
@@ -0,0 +1,125 @@
+import asyncio
+from flask import g
+from .breaker import FlarfBreakerOpen
+from .flarf import FlarfMemo
+from .stats import timer
+
+
+_missing = object()
+
+
+def run_sync(coro):
+    """Runs coro to completion on a new event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def call(afilter, name, request):
+    """The async counterpart of FlarfFilter.call"""
+    breaker = afilter.filter_breakers.get(name)
+    if breaker is None:
+        return await afilter.filter_params[name](request)
+    if not breaker.allow():
+        raise FlarfBreakerOpen(breaker.name)
+    start = timer()
+    try:
+        value = await afilter.filter_params[name](request)
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success(timer() - start)
+    return value
+
+
+async def evaluate(afilter, name, request):
+    """The async counterpart of FlarfFilter.evaluate"""
+    start = timer() if afilter.filter_stats is not None else None
+    try:
+        cache_key = afilter.filter_specs[name].cache_key
+        if cache_key is None:
+            return await call(afilter, name, request)
+        key = (name, cache_key(request))
+        value = afilter.filter_cache.get(key, _missing)
+        if value is _missing:
+            value = await call(afilter, name, request)
+            afilter.filter_cache.set(key, value)
+        return value
+    except FlarfBreakerOpen:
+        return afilter.fallback_for(name, request)
+    finally:
+        if start is not None:
+            afilter.filter_stats.timing(afilter.filter_tag,
+                                        'param:{}'.format(name),
+                                        timer() - start)
+
+
+async def bounded(afilter, name, request):
+    """Evaluates an async param within its budget, if any"""
+    budget = afilter.budget_for(name)
+    if budget is None:
+        return await evaluate(afilter, name, request)
+    try:
+        return await asyncio.wait_for(evaluate(afilter, name, request), budget)
+    except asyncio.TimeoutError:
+        afilter.filter_overruns.incr(name)
+        return afilter.fallback_for(name, request)
+
+
+async def gather_params(afilter, names, request):
+    """Awaits the async params names of afilter concurrently, returns a dict"""
+    values = await asyncio.gather(*[bounded(afilter, k, request) for k in names])
+    return dict(zip(names, values))
+
+
+async def prepare(filters, request, memo):
+    """
+    Awaits the async params of filters not yet in memo into memo, all
+    concurrently, each shared param once
+    """
+    missing = {}
+    for f in filters:
+        for k in f.filter_async:
+            key = f.filter_keys[k]
+            if key not in memo and key not in missing:
+                missing[key] = bounded(f, k, request)
+    if missing:
+        values = await asyncio.gather(*missing.values())
+        memo.update(zip(missing.keys(), values))
+
+
+def async_runner(flarf):
+    """
+    Returns an async before request function running the filters of flarf.
+    The async params of the filters selected to run now (not deferred,
+    sampled, not run by the middleware) are awaited into the request memo,
+    then the filters are run as in Flarf.flarf_run_filters.
+    """
+    async def flarf_run_filters_async():
+        request = flarf.flarf_request()
+        if request is None:
+            return None
+        filters = flarf.match_filters(request)
+        flarf.request_fields(filters, request)
+        filters = flarf.select_filters(filters, request)
+        awaited = [f for f in filters if f.filter_async and f.filter_defer is None]
+        if awaited:
+            memo = getattr(g, '_flarf_memo', None)
+            if memo is None:
+                memo = g._flarf_memo = FlarfMemo(flarf.shared_keys)
+            await prepare(awaited, request, memo)
+        return flarf.run_filters(filters, request)
+    return flarf_run_filters_async
+
+
+def sync_runner(fn):
+    """
+    A sync before request function running the async fn on a new event loop
+    per request, for flask versions calling before request functions
+    without awaiting them (before flask 2.0)
+    """
+    def flarf_run_filters_sync():
+        return run_sync(fn())
+    return flarf_run_filters_sync
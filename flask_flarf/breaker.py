@@ -0,0 +1,88 @@
+import time
+import threading
+from collections import deque
+from .stats import timer
+
+
+class FlarfBreakerOpen(Exception):
+    """Raised in place of calling a param resolver whose breaker is open"""
+
+
+class FlarfBreaker(object):
+    """
+    A circuit breaker around a param resolver. After enough consecutive
+    failures the breaker opens and the resolver is skipped; once reset
+    seconds have passed a single probe call is let through (half open), which
+    closes the breaker on success or opens it again on failure.
+
+    :param failures:            Consecutive failures that open the breaker,
+                                defaults to 5
+    :param latency:             Seconds over which a call that returns still
+                                counts as a failure, defaults to None
+    :param reset:               Seconds the breaker stays open before probing,
+                                defaults to 30
+    :param name:                A name used in transitions, FlarfFilter sets
+                                '<filter_tag>.<param>' when not given
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures=5, latency=None, reset=30, name=None):
+        self.failures = failures
+        self.latency = latency
+        self.reset = reset
+        self.name = name
+        self.state = self.CLOSED
+        self.failed = 0
+        self.opened = None
+        self.probing = False
+        self.skipped = 0
+        self.transitions = deque(maxlen=100)
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def transition(self, state):
+        """Must be called holding self.lock"""
+        event = (time.time(), self.name, self.state, state)
+        self.state = state
+        self.transitions.append(event)
+        for listener in self.listeners:
+            listener(*event)
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and timer() - self.opened >= self.reset:
+                self.transition(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN and not self.probing:
+                self.probing = True
+                return True
+            self.skipped += 1
+            return False
+
+    def success(self, elapsed):
+        if self.latency is not None and elapsed > self.latency:
+            return self.failure()
+        with self.lock:
+            self.failed = 0
+            self.probing = False
+            if self.state != self.CLOSED:
+                self.transition(self.CLOSED)
+
+    def failure(self):
+        with self.lock:
+            self.failed += 1
+            self.probing = False
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and self.failed >= self.failures):
+                self.opened = timer()
+                self.transition(self.OPEN)
+
+    def stats(self):
+        with self.lock:
+            return {'state': self.state,
+                    'failed': self.failed,
+                    'skipped': self.skipped,
+                    'transitions': list(self.transitions)}
@@ -0,0 +1,248 @@
+import os
+import time
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+
+
+_now = getattr(time, 'monotonic', time.time)
+
+
+class _Flight(object):
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class FlarfCache(object):
+    """
+    A thread safe, bounded LRU cache with an optional time to live, shared
+    across requests.
+
+    :param maxsize:             The most entries kept, least recently used
+                                entries are evicted first. Defaults to 128
+    :param ttl:                 Seconds an entry is kept, defaults to None
+                                (until evicted)
+    :param maxbytes:            The most total size of the entries kept, as
+                                measured by sizeof, defaults to None (no limit)
+    :param sizeof:              A function giving the size of a value, defaults
+                                to len
+
+    Misses computed through get_or_compute are single flight: concurrent
+    misses on the same key wait for the first to finish and share its value
+    (or exception) instead of all computing it.
+    """
+    def __init__(self, maxsize=128, ttl=None, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.data = OrderedDict()
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def lookup(self, key):
+        """Returns (found, value), must be called holding self.lock"""
+        try:
+            entry = self.data.pop(key)
+        except KeyError:
+            return False, None
+        if entry[0] is not None and entry[0] <= _now():
+            self.bytes -= entry[2]
+            self.expirations += 1
+            return False, None
+        self.data[key] = entry
+        return True, entry[1]
+
+    def store(self, key, value):
+        """Must be called holding self.lock"""
+        self.discard(key)
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        self.data[key] = (_now() + self.ttl if self.ttl else None, value, size)
+        self.bytes += size
+        while self.data and (len(self.data) > self.maxsize or
+                             (self.maxbytes is not None and self.bytes > self.maxbytes)):
+            self.bytes -= self.data.popitem(last=False)[1][2]
+            self.evictions += 1
+
+    def discard(self, key):
+        """Must be called holding self.lock"""
+        entry = self.data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def get(self, key, default=None):
+        with self.lock:
+            found, value = self.lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        with self.lock:
+            self.store(key, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.bytes = 0
+
+    def get_or_compute(self, key, compute):
+        with self.lock:
+            found, value = self.lookup(key)
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        else:
+            with self.lock:
+                self.store(key, flight.value)
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.value
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.data),
+                    'maxsize': self.maxsize,
+                    'bytes': self.bytes,
+                    'maxbytes': self.maxbytes,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations,
+                    'coalesced': self.coalesced}
+
+
+class FlarfSqliteCache(object):
+    """
+    A bounded cache in a local SQLite file, shared by the worker processes of
+    a server, with the get/set/stats interface of FlarfCache. Values are
+    pickled; least recently read entries are evicted first.
+
+    :param path:                The database file
+    :param maxsize:             The most entries kept, defaults to 1024
+    :param ttl:                 Seconds an entry is kept, defaults to None
+    :param maxbytes:            The most total size of the pickled values,
+                                defaults to None (no limit)
+
+    Connections are opened on first use by each thread, and again in a
+    forked child, so it may be created before a server forks its workers.
+    """
+    def __init__(self, path, maxsize=1024, ttl=None, maxbytes=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def connect(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute('PRAGMA journal_mode=WAL')
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS flarf_cache ('
+                           'key TEXT PRIMARY KEY, expires REAL, read REAL, '
+                           'size INTEGER, value BLOB)')
+            self.local.db, self.local.pid = db, os.getpid()
+        return self.local.db
+
+    def count(self, counter, n=1):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get(self, key, default=None):
+        now = time.time()
+        db = self.connect()
+        row = db.execute('SELECT value FROM flarf_cache WHERE key = ? AND '
+                         '(expires IS NULL OR expires > ?)', (repr(key), now)).fetchone()
+        if row is None:
+            self.count('misses')
+            return default
+        with db:
+            db.execute('UPDATE flarf_cache SET read = ? WHERE key = ?', (now, repr(key)))
+        self.count('hits')
+        return pickle.loads(bytes(row[0]))
+
+    def set(self, key, value):
+        now = time.time()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO flarf_cache VALUES (?, ?, ?, ?, ?)',
+                       (repr(key), now + self.ttl if self.ttl else None, now,
+                        len(data), sqlite3.Binary(data)))
+            db.execute('DELETE FROM flarf_cache WHERE expires <= ?', (now,))
+            self.evict(db)
+
+    def evict(self, db):
+        count, size = db.execute('SELECT COUNT(*), TOTAL(size) FROM flarf_cache').fetchone()
+        while count > self.maxsize or (self.maxbytes is not None and size > self.maxbytes):
+            row = db.execute('SELECT key, size FROM flarf_cache ORDER BY read LIMIT 1').fetchone()
+            if row is None:
+                break
+            db.execute('DELETE FROM flarf_cache WHERE key = ?', (row[0],))
+            count, size = count - 1, size - row[1]
+            self.count('evictions')
+
+    def delete(self, key):
+        with self.connect() as db:
+            db.execute('DELETE FROM flarf_cache WHERE key = ?', (repr(key),))
+
+    def clear(self):
+        with self.connect() as db:
+            db.execute('DELETE FROM flarf_cache')
+
+    def stats(self):
+        count, size = self.connect().execute(
+            'SELECT COUNT(*), TOTAL(size) FROM flarf_cache').fetchone()
+        with self.lock:
+            return {'size': count,
+                    'maxsize': self.maxsize,
+                    'bytes': int(size),
+                    'maxbytes': self.maxbytes,
+                    'ttl': self.ttl,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
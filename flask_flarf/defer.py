@@ -0,0 +1,119 @@
+import os
+import logging
+import threading
+from werkzeug.datastructures import Headers, MultiDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+logger = logging.getLogger('flask_flarf')
+
+
+class FlarfSnapshot(object):
+    """
+    A copy of the request fields a deferred filter needs, standing in for the
+    request once the request is over.
+
+    :param request:             The request to copy from
+    :param fields:              The request attributes to copy
+    """
+    def __init__(self, request, fields):
+        for field in fields:
+            setattr(self, field, self.copy(getattr(request, field, None)))
+
+    def copy(self, value):
+        if isinstance(value, MultiDict):
+            return MultiDict(value)
+        elif isinstance(value, Headers):
+            return Headers(value)
+        elif isinstance(value, dict):
+            return dict(value)
+        return value
+
+
+class FlarfQueue(object):
+    """
+    A bounded queue of deferred calls, run by background worker threads.
+
+    :param maxsize:             The most calls waiting, defaults to 1000
+    :param drop:                When full, 'new' drops the call being added,
+                                'old' drops the oldest waiting call. Defaults
+                                to 'new'
+    :param workers:             The worker threads, defaults to 1
+
+    Workers are started on first put, and again in a forked child.
+    """
+    def __init__(self, maxsize=1000, drop='new', workers=1):
+        if drop not in ('new', 'old'):
+            raise ValueError("drop must be 'new' or 'old'")
+        self.maxsize = maxsize
+        self.drop = drop
+        self.workers = workers
+        self.queue = queue.Queue(maxsize)
+        self.pid = None
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.done = 0
+        self.errors = 0
+
+    def start(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    self.queue = queue.Queue(self.maxsize)
+                    for i in range(self.workers):
+                        t = threading.Thread(target=self.work, args=(self.queue,),
+                                             name='flarf-deferred-{}'.format(i))
+                        t.daemon = True
+                        t.start()
+                    self.pid = os.getpid()
+
+    def put(self, fn, *args):
+        self.start()
+        while True:
+            try:
+                self.queue.put_nowait((fn, args))
+                return True
+            except queue.Full:
+                if self.drop == 'new':
+                    self.count('dropped')
+                    return False
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.count('dropped')
+            except queue.Empty:
+                pass
+
+    def count(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def work(self, q):
+        while True:
+            fn, args = q.get()
+            try:
+                fn(*args)
+            except Exception:
+                self.count('errors')
+                logger.exception('Deferred flarf filter failed')
+            else:
+                self.count('done')
+            finally:
+                q.task_done()
+
+    def join(self):
+        """Blocks until every queued call has run"""
+        self.queue.join()
+
+    def stats(self):
+        with self.lock:
+            return {'depth': self.queue.qsize(),
+                    'maxsize': self.maxsize,
+                    'drop': self.drop,
+                    'dropped': self.dropped,
+                    'done': self.done,
+                    'errors': self.errors}
@@ -0,0 +1,296 @@
+import math
+import hashlib
+import threading
+from functools import partial
+from flask import g, current_app, after_this_request
+from werkzeug.http import is_resource_modified
+from .admission import FlarfLimits
+from .cache import FlarfCache
+from .flarf import FlarfFilter
+from .stats import FlarfCounter
+
+
+def _param_value(result, name):
+    """A param of result, or '<filter_tag>.<param>' of an earlier filter on g"""
+    if '.' in name:
+        tag, _, name = name.partition('.')
+        result = getattr(g, tag, None)
+    return getattr(result, name, None)
+
+
+class FlarfConditionalFilter(FlarfFilter):
+    """
+    A filter answering conditional GET and HEAD requests with 304 Not
+    Modified before the view runs, when the page is determined by a few param
+    values: an ETag is fingerprinted from them and compared to If-None-Match,
+    and a last modified param to If-Modified-Since. Other responses get the
+    ETag and Last-Modified headers. Set a filter_precedence after the filters
+    it reads params from.
+
+    :param etag_params:         The params fingerprinted into the ETag, own
+                                param names or '<filter_tag>.<param>' of other
+                                filters. Defaults to all params of the filter
+    :param last_modified:       A param (as for etag_params) giving the
+                                datetime the page was last modified
+    :param weak:                Use weak ETags, defaults to False
+    """
+    def __init__(self, etag_params=None, last_modified=None, weak=False, **kwargs):
+        super(FlarfConditionalFilter, self).__init__(**kwargs)
+        if etag_params is None:
+            etag_params = list(self.filter_params)
+        self.etag_params = tuple(etag_params)
+        self.last_modified = last_modified
+        self.weak = weak
+
+    def fingerprint(self, result):
+        values = [(name, _param_value(result, name)) for name in self.etag_params]
+        return hashlib.md5(repr(values).encode('utf-8')).hexdigest()
+
+    def filter_request(self, request):
+        result = self.filter_by_param(request)
+        setattr(g, self.filter_tag, result)
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        etag = self.fingerprint(result)
+        last_modified = None
+        if self.last_modified is not None:
+            last_modified = _param_value(result, self.last_modified)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            response = current_app.response_class(status=304)
+            return self.set_validators(response, etag, last_modified)
+
+        @after_this_request
+        def add_validators(response):
+            if response.status_code == 200 and 'ETag' not in response.headers:
+                self.set_validators(response, etag, last_modified)
+            return response
+        return None
+
+    def set_validators(self, response, etag, last_modified):
+        response.set_etag(etag, weak=self.weak)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        return response
+
+
+class FlarfCacheFilter(FlarfFilter):
+    """
+    A filter caching whole responses, keyed on the request path, query string
+    and chosen param values, and returning cached responses before the view
+    runs.
+
+    Only 200 responses to GET and HEAD that are not streamed, set no cookies,
+    have no Vary header and no private, no-store or no-cache Cache-Control
+    are stored. Concurrent misses on the same key are single flight
+    within a process: the first request renders the view while the others
+    wait up to flight_timeout seconds for its response. Set a
+    filter_precedence after the filters it reads params from.
+
+    :param key_params:          The params the cache is keyed on (with the
+                                path), own param names or '<filter_tag>.<param>'
+                                of other filters. Defaults to all params of
+                                the filter
+    :param key_query:           Key the cache on the query string too, defaults
+                                to True. Turn it off only when key_params
+                                cover every query arg the views read
+    :param cache_store:         Where responses are kept, a FlarfCache (in
+                                process) or FlarfSqliteCache (shared by
+                                workers). Defaults to a FlarfCache of
+                                cache_size, cache_ttl and cache_bytes
+    :param cache_size:          The most responses kept, defaults to 1024
+    :param cache_ttl:           Seconds a response is kept, defaults to 300
+    :param cache_bytes:         The most total body size kept, defaults to
+                                64MB
+    :param flight_timeout:      Seconds a miss waits on a concurrent miss of
+                                the same key, defaults to 5
+    """
+    def __init__(self,
+                 key_params=None,
+                 key_query=True,
+                 cache_store=None,
+                 cache_size=1024,
+                 cache_ttl=300,
+                 cache_bytes=64 * 1024 * 1024,
+                 flight_timeout=5,
+                 **kwargs):
+        super(FlarfCacheFilter, self).__init__(**kwargs)
+        if key_params is None:
+            key_params = list(self.filter_params)
+        self.key_params = tuple(key_params)
+        self.key_query = key_query
+        if cache_store is None:
+            cache_store = FlarfCache(maxsize=cache_size,
+                                     ttl=cache_ttl,
+                                     maxbytes=cache_bytes,
+                                     sizeof=lambda v: len(v[2]))
+        self.cache_store = cache_store
+        self.flight_timeout = flight_timeout
+        self.flights = {}
+        self.flights_lock = threading.Lock()
+        self.counts = FlarfCounter()
+
+    def response_key(self, request, result):
+        key = (request.path, request.query_string) if self.key_query else (request.path,)
+        return key + tuple(_param_value(result, name) for name in self.key_params)
+
+    def cacheable(self, response):
+        if response.status_code != 200 or response.is_streamed or \
+                'Set-Cookie' in response.headers or 'Vary' in response.headers:
+            return False
+        cache_control = response.cache_control
+        return not (cache_control.private or cache_control.no_store or
+                    cache_control.no_cache)
+
+    def cached_response(self, key):
+        cached = self.cache_store.get(key)
+        if cached is None:
+            return None
+        status, headers, body = cached
+        return current_app.response_class(body, status=status, headers=headers)
+
+    def filter_request(self, request):
+        result = self.filter_by_param(request)
+        setattr(g, self.filter_tag, result)
+        if request.method not in ('GET', 'HEAD'):
+            return None
+        key = self.response_key(request, result)
+        response = self.cached_response(key)
+        if response is None:
+            with self.flights_lock:
+                flight = self.flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self.flights[key] = threading.Event()
+            if not leader:
+                self.counts.incr('coalesced')
+                flight.wait(self.flight_timeout)
+                response = self.cached_response(key)
+        if response is not None:
+            self.counts.incr('hits')
+            return response
+        self.counts.incr('misses')
+        if leader:
+            self.on_teardown(partial(self.land, key, flight))
+
+        @after_this_request
+        def store(response):
+            self.store(key, response)
+            return response
+        return None
+
+    def land(self, key, flight, exc=None):
+        with self.flights_lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+        flight.set()
+
+    def store(self, key, response):
+        if not self.cacheable(response):
+            self.counts.incr('uncacheable')
+            return
+        self.cache_store.set(key, (response.status_code,
+                                   list(response.headers.items()),
+                                   response.get_data()))
+        self.counts.incr('stored')
+
+    def report(self):
+        counts = self.counts.snapshot()
+        hits, misses = counts.get('hits', 0), counts.get('misses', 0)
+        counts['hit_ratio'] = float(hits) / (hits + misses) if hits + misses else None
+        counts['store'] = self.cache_store.stats()
+        return counts
+
+
+class FlarfAdmissionFilter(FlarfFilter):
+    """
+    A filter shedding load before any other filter or the view runs: a
+    request over the in flight limit of its route is answered 503, one over
+    its rate 429, both with Retry-After. The routes are those of filter_on
+    and filter_pass, each url rule counted apart. Requests matching no url
+    rule are not limited: flarf runs no filter on them. filter_precedence
+    defaults to 0, run it first.
+
+    :param max_inflight:        The most requests in flight per route, defaults
+                                to None (no limit)
+    :param rate:                Requests per second per route, a token bucket
+                                of burst tokens, defaults to None (no limit)
+    :param burst:               The most requests over rate at once, defaults
+                                to rate (at least 1)
+    :param route_limits:        {url rule or endpoint: dict of max_inflight,
+                                rate and burst} overriding the limits above
+                                for some routes
+    :param limits:              Where counts are kept, a FlarfLimits (shared by
+                                threads) or FlarfSharedLimits (shared by worker
+                                processes). Defaults to a FlarfLimits
+    :param retry_after:         Seconds sent in Retry-After on 503, defaults
+                                to 1
+
+    report gives per route the requests admitted, shed for 'concurrency'
+    (503) and for 'rate' (429), and those in flight now; see Flarf.stats_report
+    'filters'.
+    """
+    def __init__(self,
+                 max_inflight=None,
+                 rate=None,
+                 burst=None,
+                 route_limits=None,
+                 limits=None,
+                 retry_after=1,
+                 **kwargs):
+        kwargs.setdefault('filter_precedence', 0)
+        kwargs.setdefault('filter_params', [])
+        super(FlarfAdmissionFilter, self).__init__(**kwargs)
+        self.default_limits = self.route_limit(max_inflight, rate, burst)
+        self.route_limits = dict((route, self.route_limit(**l))
+                                 for route, l in (route_limits or {}).items())
+        self.limits = limits if limits is not None else FlarfLimits()
+        self.retry_after = retry_after
+        self.counts = FlarfCounter()
+        self.routes = set()
+
+    def route_limit(self, max_inflight=None, rate=None, burst=None):
+        if rate is not None and burst is None:
+            burst = max(1, rate)
+        return (max_inflight, rate, burst)
+
+    def limits_for(self, request):
+        rule = request.url_rule.rule
+        limits = self.route_limits.get(rule)
+        if limits is None:
+            limits = self.route_limits.get(request.endpoint, self.default_limits)
+        return rule, limits
+
+    def shed(self, route, reason, status, retry_after):
+        self.counts.incr((route, reason))
+        response = current_app.response_class(status=status)
+        response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return response
+
+    def filter_request(self, request):
+        route, (max_inflight, rate, burst) = self.limits_for(request)
+        self.routes.add(route)
+        # concurrency first, so a request shed with 503 takes no rate token
+        if max_inflight is not None:
+            if not self.limits.acquire(route, max_inflight):
+                return self.shed(route, 'concurrency', 503, self.retry_after)
+        if rate is not None:
+            wait = self.limits.take(route, rate, burst)
+            if wait:
+                if max_inflight is not None:
+                    self.limits.release(route)
+                return self.shed(route, 'rate', 429, wait)
+        if max_inflight is not None:
+            self.on_teardown(partial(self.release, route))
+        self.counts.incr((route, 'admitted'))
+        setattr(g, self.filter_tag, self.filter_by_param(request))
+
+    def release(self, route, exc=None):
+        self.limits.release(route)
+
+    def report(self):
+        report = {}
+        for (route, reason), n in self.counts.snapshot().items():
+            report.setdefault(route, {})[reason] = n
+        for route in list(self.routes):
+            report.setdefault(route, {})['inflight'] = self.limits.inflight(route)
+        return report
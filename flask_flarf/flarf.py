@@ -1,20 +1,241 @@
+import gc
+import io
 import re
-from operator import attrgetter
+import sys
+import inspect
+import threading
 from types import FunctionType
 from functools import partial
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from werkzeug import LocalProxy
-from flask import Blueprint, g, _request_ctx_stack, current_app
-import pprint
+from flask import Blueprint, g, _app_ctx_stack, _request_ctx_stack, current_app, jsonify
+from jinja2 import meta, nodes
+from jinja2.utils import missing
+try:
+    from types import MappingProxyType
+except ImportError:
+    MappingProxyType = None
+from werkzeug.formparser import FormDataParser
+from .breaker import FlarfBreaker, FlarfBreakerOpen
+from .cache import FlarfCache
+from .defer import FlarfQueue, FlarfSnapshot, logger
+from .graph import FlarfGraph
+from .matcher import FlarfMatcher
+from .middleware import FlarfMiddleware
+from .sampling import FlarfSampler, FlarfSkipped
+from .pool import FIRST_COMPLETED, FlarfPool, FutureTimeout, ThreadPoolExecutor, wait
+from .stats import FlarfCounter, FlarfStats, timer
 
 
 fs = LocalProxy(lambda: current_app.extensions['flarf'].filters)
-_rp = LocalProxy(lambda: _endpoints(_request_ctx_stack.top.request))
-_rerror = LocalProxy(lambda: _request_ctx_stack.top.request.routing_exception)
 
 
-def _endpoints(r):
-    return (str(r.endpoint).rsplit('.')[-1], r.endpoint.rsplit(':')[-1], r.path)
+def _endpoints(endpoint):
+    return (str(endpoint).rsplit('.')[-1], str(endpoint).rsplit(':')[-1])
+
+
+_identifier = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', lambda f: False)
+
+
+def _func(method):
+    return getattr(method, '__func__', method)
+
+
+class _Discard(io.BytesIO):
+    """A file part sink for streamed form parsing, keeping nothing"""
+    def write(self, b):
+        return len(b)
+
+
+def _discard(*args, **kwargs):
+    return _Discard()
+
+
+def _lookup_g(tag, stats=None):
+    if stats is None:
+        return getattr(g, tag, None)
+    start = timer()
+    try:
+        return getattr(g, tag, None)
+    finally:
+        stats.timing(tag, 'ctx_prc', timer() - start)
+
+
+def _sizeof(obj, seen=None):
+    """
+    Bytes held by obj and the containers in it; other objects (filters,
+    functions, regexes) count for their own size only
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, MappingProxyType or dict)):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(_sizeof(v, seen) for v in obj)
+    return size
+
+
+def _route_key(request):
+    rule = request.url_rule
+    return (request.endpoint, rule.rule if rule is not None else None)
+
+
+class FlarfParam(object):
+    """
+    Wraps a filter param with per param options, for use in filter_params
+
+    :param param:               A string or function, as for filter_params
+    :param lazy:                Compute the param the first time it is read
+                                from the filter result instead of on request.
+                                Defaults to the filter_lazy of the filter
+    :param cache_key:           A function taking request and returning a
+                                hashable key of everything the param depends
+                                on. The param value is then cached across
+                                requests in the filter cache under this key
+    :param io_bound:            The param waits on I/O (a remote call), run it
+                                on the Flarf thread pool alongside the other
+                                io_bound params of the filter. It is passed
+                                request, but runs outside the request context
+    :param budget:              Seconds the request waits for an io_bound (or
+                                async) param, after which the fallback is used
+                                and the overrun counted. Budgeted io_bound
+                                params run on the Flarf budget pool (and keep
+                                running there when overdue), at most
+                                budget_inflight calls of the param at once.
+                                Defaults to the filter_budget of the filter
+    :param fallback:            The value used when the budget runs out or the
+                                breaker is open, or a function taking request
+                                returning it. Defaults to the filter_fallback
+                                of the filter
+    :param breaker:             A FlarfBreaker around the param resolver,
+                                defaults to one made from filter_breaker
+    """
+    def __init__(self,
+                 param,
+                 lazy=None,
+                 cache_key=None,
+                 io_bound=False,
+                 budget=None,
+                 fallback=None,
+                 breaker=None):
+        self.param = param
+        self.lazy = lazy
+        self.cache_key = cache_key
+        self.io_bound = io_bound
+        self.budget = budget
+        self.fallback = fallback
+        self.breaker = breaker
+
+
+class FlarfMemo(dict):
+    """
+    Per request memo of param values shared by more than one filter, keyed
+    on FlarfFilter.filter_keys; saved counts the evaluations it spared.
+    Filters run in parallel (see Flarf parallel) share it through lookup and
+    store.
+    """
+    def __init__(self, shared):
+        super(FlarfMemo, self).__init__()
+        self.shared = shared
+        self.saved = 0
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """(True, value) of key, counting the evaluation spared, or (False, None)"""
+        with self.lock:
+            if key in self:
+                self.saved += 1
+                return True, self[key]
+        return False, None
+
+    def store(self, key, value):
+        """Stores value under key unless already stored, returns the value kept"""
+        with self.lock:
+            return self.setdefault(key, value)
+
+
+def _template_context(base, flarf):
+    """
+    A jinja context class over base resolving the filter tags of flarf, when
+    not otherwise defined, to the filter result on g (or None) on their
+    first reference in a template: the result itself, so `is none` tests
+    and truthiness behave as on g, and tags a template never names are
+    never looked up.
+    """
+    def lookup(key):
+        if key in flarf.ctx and _app_ctx_stack.top is not None:
+            return _lookup_g(key, flarf.stats)
+        return missing
+
+    class FlarfTemplateContext(base):
+        if hasattr(base, 'resolve_or_missing'):
+            def resolve_or_missing(self, key):
+                rv = base.resolve_or_missing(self, key)
+                return lookup(key) if rv is missing else rv
+        else:
+            def resolve(self, key):
+                if key not in self.vars and key not in self.parent:
+                    rv = lookup(key)
+                    if rv is not missing:
+                        return rv
+                return base.resolve(self, key)
+    return FlarfTemplateContext
+
+
+class FlarfFields(dict):
+    """
+    The plain params of the filters run on a request, looked up in one pass
+    over request.view_args and one over request.args, first truthy value
+    winning. names are all the params looked up, so a name in names but not
+    in the mapping is not in the url.
+    """
+    def __init__(self, request, names):
+        super(FlarfFields, self).__init__()
+        self.names = names
+        for source in (request.view_args, request.args):
+            if source:
+                for k, v in source.items():
+                    if v and k in names and k not in self:
+                        self[k] = v
+
+
+class FlarfResult(object):
+    """
+    The per request result of a FlarfFilter, placed on g under the filter
+    tag. Params are set as attributes, lazy params on first read; anything
+    else is read from the filter. Subclasses with __slots__ for the filter
+    params are made by FlarfFilter.set_result_cls.
+    """
+    __slots__ = ('_filter', '_request')
+
+    def __init__(self, afilter, request):
+        self._filter = afilter
+        self._request = request
+
+    def __getattr__(self, name):
+        if name in self._filter.filter_lazy:
+            value = self._filter.resolve(name, self._request, self._filter.request_memo())
+            setattr(self, name, value)
+            return value
+        return getattr(self._filter, name)
+
+    def untouched(self):
+        """Lazy params not read on this request"""
+        untouched = []
+        for k in self._filter.filter_lazy:
+            try:
+                object.__getattribute__(self, k)
+            except AttributeError:
+                untouched.append(k)
+        return untouched
+
+    def __repr__(self):
+        return '<{} {}>'.format(self.__class__.__name__, self._filter.filter_tag)
 
 
 class FlarfFilter(object):
@@ -28,7 +249,8 @@ class FlarfFilter(object):
                                 largest
     :param filter_params:       A list of paramaters used by the filter on request.
                                 May be either string or function:
-                                   - a function that takes request as an argument
+                                   - a function that takes request as an argument,
+                                     or an async function (see Flarf run_async)
                                    - a string 'request_x', indicating x is to be
                                      returned from request, e.g. 'request_path'
                                      to have the filter get request.path
@@ -36,32 +258,281 @@ class FlarfFilter(object):
                                      the filter where 'var' is the variable you'd
                                      like the filter to capture e.g. 'get_var'
                                      will do self.get_var(request) to set self.var
-                                   - a string for a var found in request.values,
-                                     request.form, or request.files
+                                   - a string for a var found in
+                                     request.view_args, request.args,
+                                     request.form, or request.files, in that
+                                     order. The body is only parsed when the
+                                     var is not in the url
+                                   - a FlarfParam wrapping any of the above
+                                     with per param options
     :param filter_on:           A list of routes to use the filter on, default
                                 is ['all'], except static routes
     :param filter_pass:         A list routes/endpoints to pass over and not
                                 use filter. By default, all static routes are
                                 skipped
+    :param filter_lazy:         True to compute all params on first read from
+                                the filter result rather than on request, or a
+                                list of param names to compute lazily. Lazy
+                                params are computed at most once per request
+    :param filter_cache_size:   The most values kept in the filter cache for
+                                params with a FlarfParam cache_key, defaults
+                                to 128
+    :param filter_cache_ttl:    Seconds a cached param value is kept, defaults
+                                to None (until evicted)
+    :param filter_budget:       Seconds the request waits for each (non lazy)
+                                io_bound or async param of the filter, see
+                                FlarfParam budget
+    :param filter_fallback:     The value, or function taking request, used
+                                for params not resolved within their budget or
+                                skipped by an open breaker
+    :param filter_breaker:      True, or a dict of FlarfBreaker arguments, to
+                                put a circuit breaker around each param
+                                resolver without a FlarfParam breaker
+    :param filter_defer:        Run the filter after the response instead of
+                                before the view: 'close' when the response is
+                                closed (response.call_on_close), or at teardown
+                                when the view raised and no after request ran,
+                                'queue' on the Flarf deferred queue. A deferred filter is
+                                passed a FlarfSnapshot of the request, within
+                                an app context of its own; its result is not
+                                seen by the view and its return value ignored
+    :param filter_snapshot:     The request attributes copied for a deferred
+                                filter, defaults to the common request fields
+                                and those the filter params read
+    :param filter_wsgi:         Run the filter in the FlarfMiddleware (see Flarf
+                                middleware), on a plain werkzeug request over
+                                the WSGI environ before flask builds a request
+                                context. For cheap filters reading only the
+                                path, host, headers or query string; the flask
+                                request proxy and session are not available
+    :param filter_stream:       Parse multipart bodies for params without
+                                keeping file parts: file parts are discarded
+                                and request.files is left empty for the view.
+                                For routes whose views don't read uploads,
+                                defaults to False
+    :param filter_max_body:     Bytes over which (or with no content length)
+                                the body is not parsed for params, which are
+                                then None, defaults to None (no ceiling)
+    :param filter_depends:      A list of filter tags this filter depends on,
+                                e.g. reading g.user_filter. It is run after
+                                them whatever its filter_precedence, and with
+                                Flarf parallel, filters of the same
+                                filter_precedence not depending on each other
+                                are run concurrently
+    :param filter_sample:       Run the filter on some requests only: a rate
+                                (the fraction of requests), a dict of
+                                FlarfSampler arguments or a FlarfSampler. On
+                                other requests no params are resolved and g
+                                holds a FlarfSkipped, false with every param
+                                None. Defaults to None (every request)
     """
     def __init__(self,
                  filter_tag,
                  filter_precedence=100,
                  filter_params=None,
                  filter_on=None,
-                 filter_pass=None):
+                 filter_pass=None,
+                 filter_lazy=None,
+                 filter_cache_size=128,
+                 filter_cache_ttl=None,
+                 filter_budget=None,
+                 filter_fallback=None,
+                 filter_breaker=None,
+                 filter_defer=None,
+                 filter_snapshot=None,
+                 filter_wsgi=False,
+                 filter_stream=False,
+                 filter_max_body=None,
+                 filter_depends=None,
+                 filter_sample=None):
         self.filter_tag = filter_tag
         self.filter_precedence = filter_precedence
+        self.filter_depends = tuple(filter_depends or ())
+        self.filter_sample = self.set_sample(filter_sample)
+        self.filter_skipped = FlarfSkipped(filter_tag)
+        self.filter_stream = filter_stream
+        self.filter_max_body = filter_max_body
         self.filter_params = self.set_params(filter_params)
+        self.filter_specs = self.set_specs(filter_params)
+        self.filter_lazy = self.set_lazy(filter_lazy)
+        self.filter_budget = filter_budget
+        self.filter_fallback = filter_fallback
+        self.filter_overruns = FlarfCounter()
+        self.filter_breakers = self.set_breakers(filter_breaker)
+        self.filter_keys = self.set_keys(filter_params)
+        self.filter_defer = self.set_defer(filter_defer)
+        self.filter_snapshot = self.set_snapshot(filter_snapshot)
+        self.filter_wsgi = filter_wsgi
+        self.filter_fields = self.set_fields()
+        self.filter_io = self.set_io()
+        self.filter_async = self.set_async()
+        self.check_budgets()
+        self.filter_cache = self.set_cache(filter_cache_size, filter_cache_ttl)
+        self.filter_stats = None
+        self.filter_pool = None
+        self.filter_budget_pool = None
+        self.filter_caps = {}
+        self.filter_shared = False
         self.filter_on = self.set_filter_on(filter_on)
         self.filter_pass = self.set_filter_pass(filter_pass)
+        self.result_cls = self.set_result_cls()
+
+    def set_result_cls(self):
+        names = [str(k) for k in self.filter_params]
+        slots = [k for k in names if _identifier.match(k)]
+        if len(slots) != len(names):
+            slots.append('__dict__')
+        return type(str('FlarfResult_{}'.format(self.filter_tag)),
+                    (FlarfResult,),
+                    {'__slots__': tuple(slots)})
 
     def set_params(self, params):
         return OrderedDict([self.param_is(p) for p in params])
 
+    def set_specs(self, params):
+        return OrderedDict([(self.param_is(p)[0], self.spec_is(p)) for p in params])
+
+    def set_keys(self, params):
+        keys = OrderedDict()
+        for p in params:
+            name, key = self.param_is(p)[0], self.key_is(p)
+            options = self.key_options(name)
+            if key is not None and options is not None:
+                key = (key if isinstance(key, tuple) else (key,)) + options
+            keys[name] = key
+        return keys
+
+    def key_options(self, name):
+        """
+        The options changing what param name resolves to on this filter: its
+        budget, fallback, breaker and cache_key, None when it has none
+        """
+        spec = self.filter_specs[name]
+        budget = None
+        if spec.io_bound or _iscoroutinefunction(spec.param):
+            budget = self.budget_for(name)
+        breaker = self.filter_breakers.get(name)
+        fallback = None
+        if budget is not None or breaker is not None:
+            fallback = spec.fallback if spec.fallback is not None else self.filter_fallback
+        options = (budget, fallback, breaker, spec.cache_key)
+        if all(o is None for o in options):
+            return None
+        return options
+
+    def set_lazy(self, filter_lazy):
+        if filter_lazy is True:
+            filter_lazy = self.filter_params.keys()
+        filter_lazy = filter_lazy or ()
+        return frozenset(k for k, spec in self.filter_specs.items()
+                         if (k in filter_lazy if spec.lazy is None else spec.lazy)
+                         and not _iscoroutinefunction(spec.param))
+
+    def set_fields(self):
+        return frozenset(key[1] for key in self.filter_keys.values()
+                         if isinstance(key, tuple) and key[0] == type(self).param_param)
+
+    def set_io(self):
+        return tuple(k for k, spec in self.filter_specs.items()
+                     if spec.io_bound and k not in self.filter_lazy
+                     and not _iscoroutinefunction(spec.param))
+
+    def check_budgets(self):
+        for k, spec in self.filter_specs.items():
+            if spec.budget is not None and not spec.io_bound and \
+                    not _iscoroutinefunction(spec.param):
+                raise ValueError('param {!r} of filter {!r} has a budget but is not '
+                                 'io_bound'.format(k, self.filter_tag))
+
+    def budgeted(self):
+        """The io_bound params with a budget"""
+        return [k for k in self.filter_io if self.budget_for(k) is not None]
+
+    def set_pools(self, pool, budget_pool, budget_inflight):
+        self.filter_pool = pool
+        self.filter_budget_pool = budget_pool
+        for k in self.budgeted():
+            if k not in self.filter_caps:
+                self.filter_caps[k] = threading.BoundedSemaphore(budget_inflight)
+
+    def set_async(self):
+        return tuple(k for k, spec in self.filter_specs.items()
+                     if _iscoroutinefunction(spec.param))
+
+    def set_breakers(self, filter_breaker):
+        breakers = {}
+        for k, spec in self.filter_specs.items():
+            breaker = spec.breaker
+            if breaker is None and filter_breaker:
+                if filter_breaker is True:
+                    filter_breaker = {}
+                breaker = FlarfBreaker(**filter_breaker)
+            if breaker is not None:
+                if breaker.name is None:
+                    breaker.name = '{}.{}'.format(self.filter_tag, k)
+                breakers[k] = breaker
+        return breakers
+
+    def freeze(self):
+        """
+        Makes the param tables of the filter read only mappings, plain dicts
+        where those keep their order
+        """
+        if MappingProxyType is None:
+            return
+        for name in ('filter_params', 'filter_specs', 'filter_keys'):
+            table = getattr(self, name)
+            if not isinstance(table, MappingProxyType):
+                if sys.version_info >= (3, 7):
+                    table = dict(table)
+                setattr(self, name, MappingProxyType(table))
+
+    def make_lazy(self, names):
+        """Computes the (non async) params names lazily from now on"""
+        self.filter_lazy = self.filter_lazy | frozenset(
+            k for k in names if k in self.filter_params and k not in self.filter_async)
+        self.filter_fields = self.set_fields()
+        self.filter_io = self.set_io()
+
+    def set_defer(self, filter_defer):
+        if filter_defer not in (None, 'close', 'queue'):
+            raise ValueError("filter_defer must be None, 'close' or 'queue'")
+        return filter_defer
+
+    def set_sample(self, filter_sample):
+        if filter_sample is None or isinstance(filter_sample, FlarfSampler):
+            return filter_sample
+        if isinstance(filter_sample, dict):
+            return FlarfSampler(**filter_sample)
+        return FlarfSampler(rate=filter_sample)
+
+    def set_snapshot(self, filter_snapshot):
+        if filter_snapshot is not None:
+            return tuple(filter_snapshot)
+        fields = ['path', 'full_path', 'url', 'method', 'endpoint', 'blueprint',
+                  'view_args', 'args', 'headers', 'cookies', 'remote_addr']
+        for key in self.filter_keys.values():
+            if isinstance(key, tuple) and key[1] not in fields:
+                if key[0] == type(self).param_request:
+                    fields.append(key[1])
+                elif key[0] == type(self).param_param and 'form' not in fields:
+                    fields.extend(['form', 'files', 'mimetype', 'content_length'])
+        return tuple(fields)
+
+    def set_cache(self, size, ttl):
+        if any(spec.cache_key for spec in self.filter_specs.values()):
+            return FlarfCache(maxsize=size, ttl=ttl)
+        return None
+
+    def spec_is(self, p):
+        if isinstance(p, FlarfParam):
+            return p
+        return FlarfParam(p)
+
     def set_filter_on(self, filter_on):
         if not filter_on:
             filter_on = ['all']
+        self.filter_on_list = tuple(filter_on)
         return self.re_compile_list(filter_on)
 
     def set_filter_pass(self, filter_pass):
@@ -69,13 +540,35 @@ class FlarfFilter(object):
             filter_pass = ['static']
         else:
             filter_pass.append('static')
+        self.filter_pass_list = tuple(filter_pass)
         return self.re_compile_list(filter_pass)
 
     def re_compile_list(self, l):
         return re.compile(r'(?:{})'.format('|'.join(l)))
 
+    def key_is(self, p):
+        """
+        A key identifying what a param resolves to on any filter: the same
+        request attribute, function, or request var read with the same body
+        options (filter_max_body, filter_stream). None for params that depend
+        on the filter itself (get_var). set_keys adds the key_options.
+        """
+        if isinstance(p, FlarfParam):
+            return self.key_is(p.param)
+        elif isinstance(p, FunctionType):
+            return p
+        head, _, tail = p.partition('_')
+        if head == 'request':
+            return (type(self).param_request, tail)
+        elif head in ('get', 'self'):
+            return None
+        else:
+            return (type(self).param_param, p, self.filter_max_body, self.filter_stream)
+
     def param_is(self, p):
-        if isinstance(p, FunctionType):
+        if isinstance(p, FlarfParam):
+            return self.param_is(p.param)
+        elif isinstance(p, FunctionType):
             return (p.__name__, p)
         else:
             return self.determine_param(p)
@@ -89,30 +582,217 @@ class FlarfFilter(object):
         else:
             return from_p, partial(getattr(self, 'param_param'), from_p)
 
-    def get_ctx_prc(self):
-        def ctx_prc(tag):
-            return getattr(g, tag, None)
-        return {self.filter_tag: ctx_prc(self.filter_tag)}
-
     def param_request(self, param, request):
         return getattr(request, param)
 
     def param_param(self, param, request):
-        p = [request.values.get(param, None),
-             request.view_args.get(param, None),
-             request.files.get(param, None)]
-        if any(p):
-            return list(filter(None, p)).pop()
+        fields = getattr(request, '_flarf_fields', None)
+        if fields is not None and param in fields.names:
+            value = fields.get(param)
         else:
+            value = (request.view_args or {}).get(param) or request.args.get(param)
+        if value or not self.body_allowed(request):
+            return value or None
+        if self.filter_stream and 'form' not in request.__dict__ and \
+                request.mimetype == 'multipart/form-data':
+            self.stream_form(request)
+        return request.form.get(param) or request.files.get(param) or None
+
+    def body_allowed(self, request):
+        if request.method in ('GET', 'HEAD') or not request.mimetype:
+            return False
+        if self.filter_max_body is None:
+            return True
+        length = request.content_length
+        return length is not None and length <= self.filter_max_body
+
+    def stream_form(self, request):
+        """Parses the form of request, discarding file parts, as request.form"""
+        parser = FormDataParser(stream_factory=_discard,
+                                max_form_memory_size=request.max_form_memory_size,
+                                max_content_length=request.max_content_length,
+                                cls=request.parameter_storage_class)
+        stream, form, files = parser.parse(request.stream,
+                                           request.mimetype,
+                                           request.content_length,
+                                           request.mimetype_params)
+        request.__dict__.update(stream=stream, form=form,
+                                files=request.parameter_storage_class())
+
+    def evaluate(self, name, request):
+        start = timer() if self.filter_stats is not None else None
+        try:
+            return self.compute(name, request)
+        except FlarfBreakerOpen:
+            return self.fallback_for(name, request)
+        finally:
+            if start is not None:
+                self.filter_stats.timing(self.filter_tag, 'param:{}'.format(name), timer() - start)
+
+    def compute(self, name, request):
+        cache_key = self.filter_specs[name].cache_key
+        if cache_key is None:
+            return self.call(name, request)
+        return self.filter_cache.get_or_compute((name, cache_key(request)),
+                                                partial(self.call, name, request))
+
+    def call(self, name, request):
+        breaker = self.filter_breakers.get(name)
+        if breaker is None:
+            return self.filter_params[name](request)
+        if not breaker.allow():
+            raise FlarfBreakerOpen(breaker.name)
+        start = timer()
+        try:
+            value = self.filter_params[name](request)
+        except Exception:
+            breaker.failure()
+            raise
+        breaker.success(timer() - start)
+        return value
+
+    def request_memo(self):
+        """
+        The request memo, None when no param of the filter is shared with
+        another filter (see Flarf.compile_filters)
+        """
+        if not self.filter_shared:
+            return None
+        return getattr(g, '_flarf_memo', None)
+
+    def resolve(self, name, request, memo=None):
+        if memo is None:
+            return self.evaluate(name, request)
+        key = self.filter_keys[name]
+        if key not in memo.shared:
+            return self.evaluate(name, request)
+        found, value = memo.lookup(key)
+        if found:
+            return value
+        return memo.store(key, self.evaluate(name, request))
+
+    def budget_for(self, name):
+        budgets = [b for b in (self.filter_specs[name].budget, self.filter_budget)
+                   if b is not None]
+        return min(budgets) if budgets else None
+
+    def fallback_for(self, name, request):
+        fallback = self.filter_specs[name].fallback
+        if fallback is None:
+            fallback = self.filter_fallback
+        if callable(fallback):
+            return fallback(request)
+        return fallback
+
+    def submit_io(self, k, result, request, memo):
+        """
+        Submits the io_bound param k to the pool, returns (k, future, time
+        submitted), or sets it from the request memo and returns None
+        """
+        key = self.filter_keys[k]
+        if memo is not None and key in memo.shared:
+            found, value = memo.lookup(key)
+            if found:
+                setattr(result, k, value)
+                return None
+        cap = self.filter_caps.get(k)
+        if cap is None:
+            return k, self.filter_pool.submit(self.evaluate, k, request), timer()
+        if not cap.acquire(False):
+            # budget_inflight calls of k are already running, likely overdue
+            self.filter_overruns.incr(k)
+            setattr(result, k, self.fallback_for(k, request))
             return None
+        try:
+            future = self.filter_budget_pool.submit(self.evaluate, k, request)
+        except Exception:
+            cap.release()
+            raise
+        future.add_done_callback(lambda future: cap.release())
+        return k, future, timer()
+
+    def collect_io(self, result, pending, request, memo):
+        for k, future, submitted in pending:
+            budget = self.budget_for(k)
+            try:
+                if budget is None:
+                    value = future.result()
+                else:
+                    value = future.result(max(0, submitted + budget - timer()))
+            except FutureTimeout:
+                self.filter_overruns.incr(k)
+                value = self.fallback_for(k, request)
+            key = self.filter_keys[k]
+            if memo is not None and key in memo.shared:
+                value = memo.store(key, value)
+            setattr(result, k, value)
+
+    def resolve_async(self, result, request):
+        """
+        Sets the async params, awaited concurrently by the Flarf async runner
+        into the request memo, or here on a new event loop
+        """
+        memo = getattr(g, '_flarf_memo', None)
+        missing = []
+        for k in self.filter_async:
+            key = self.filter_keys[k]
+            if memo is not None and key in memo:
+                setattr(result, k, memo[key])
+            else:
+                missing.append(k)
+        if missing:
+            from .aio import gather_params, run_sync
+            for k, value in run_sync(gather_params(self, missing, request)).items():
+                setattr(result, k, value)
 
     def filter_by_param(self, request):
-        for k, v in self.filter_params.items():
-            setattr(self, k, v(request))
+        """
+        Resolves the params in declared order. A run of adjacent io_bound
+        params is started on the pool once the params before it are done,
+        and the params after it wait for the whole run, so only the params of
+        one run must not depend on each other.
+        """
+        result = self.result_cls(self, request)
+        memo = self.request_memo()
+        pool = self.filter_pool if self.filter_io else None
+        pending = []
+        for k in self.filter_params:
+            if k in self.filter_lazy or k in self.filter_async:
+                continue
+            if pool is not None and k in self.filter_io:
+                submitted = self.submit_io(k, result, request, memo)
+                if submitted is not None:
+                    pending.append(submitted)
+                continue
+            if pending:
+                self.collect_io(result, pending, request, memo)
+                pending = []
+            setattr(result, k, self.resolve(k, request, memo))
+        if pending:
+            self.collect_io(result, pending, request, memo)
+        if self.filter_async:
+            self.resolve_async(result, request)
+        return result
 
     def filter_request(self, request):
-        self.filter_by_param(request)
-        setattr(g, self.filter_tag, self)
+        setattr(g, self.filter_tag, self.filter_by_param(request))
+
+    def may_return(self):
+        """
+        True when filter_request is overridden, so may return a response
+        ending the request
+        """
+        return _func(type(self).filter_request) is not _func(FlarfFilter.filter_request)
+
+    def on_teardown(self, fn):
+        """Calls fn(exc) when the current request is torn down"""
+        if not hasattr(g, '_flarf_teardown'):
+            g._flarf_teardown = []
+        g._flarf_teardown.append(fn)
+
+    def report(self):
+        """Stats of the filter for Flarf.stats_report, None if it has none"""
+        return None
 
 
 class Flarf(object):
@@ -126,16 +806,94 @@ class Flarf(object):
                                 FlarfFilter, used when receiving dicts as filters
     :param filters:             A list of filter instances(or dicts mappable
                                 to filter_cls instances) to be run per request.
+    :param instrument:          Time route matching, each param, each
+                                filter_request and each template lookup of a
+                                filter, see stats_report. Defaults to False
+    :param pool_size:           Worker threads in the pool shared by io_bound
+                                params, defaults to 8. With 0, or without
+                                concurrent.futures, io_bound params run inline
+                                and budgets raise ValueError
+    :param budget_pool_size:    Worker threads in the pool of io_bound params
+                                with a budget, kept apart so overdue calls
+                                don't hold the workers of other params,
+                                defaults to 4
+    :param budget_inflight:     The most calls of one budgeted param running
+                                at once, overdue ones included. Beyond it the
+                                fallback is used without calling the param,
+                                so one slow backend cannot fill the budget
+                                pool. Defaults to 2
+    :param run_async:           Use an async before request function, for
+                                async views or Quart-style apps, that awaits the
+                                async params of each filter concurrently with
+                                asyncio.gather. Filters without async params
+                                are run as usual. Flask before 2.0 cannot
+                                await it, there it is run on a new event loop
+                                per request. With the default sync function
+                                async params run on a new event loop
+    :param scan_templates:      On the first request, find the filter tags and
+                                params read by the app templates. Tags no
+                                template reads are left out of the template
+                                context, and params no template reads are made
+                                lazy (still computed when a view reads them).
+                                Only for apps rendering no templates from
+                                strings or outside the jinja loader. Defaults
+                                to False
+    :param defer_queue_size:    The most calls waiting on the deferred queue,
+                                defaults to 1000
+    :param defer_drop:          'new' or 'old', the call dropped when the
+                                deferred queue is full, defaults to 'new'
+    :param defer_workers:       Threads running the deferred queue, defaults
+                                to 1
+    :param middleware:          Wrap app.wsgi_app in a FlarfMiddleware running
+                                the filters with filter_wsgi set before flask
+                                builds a request context. Defaults to False
+    :param parallel:            Worker threads running filters that do not
+                                depend on each other (see filter_depends)
+                                concurrently, in the app and request context
+                                of the request. Filters are run level by level,
+                                a level being the filters of one
+                                filter_precedence, and filters that may return
+                                a response run alone on the request thread.
+                                Defaults to 0, running filters one after
+                                another
     """
     def __init__(self,
                  app=None,
                  before_request_func=None,
                  filter_cls=FlarfFilter,
-                 filters=None):
+                 filters=None,
+                 instrument=False,
+                 pool_size=8,
+                 budget_pool_size=4,
+                 budget_inflight=2,
+                 run_async=False,
+                 scan_templates=False,
+                 defer_queue_size=1000,
+                 defer_drop='new',
+                 defer_workers=1,
+                 middleware=False,
+                 parallel=0):
         self.app = app
+        self.run_async = run_async
+        self.middleware = middleware
+        self.scan_templates = scan_templates
+        self.template_usage = None
         self.before_request_func = self.set_before_request_func(before_request_func)
+        self.stats = FlarfStats() if instrument else None
+        self.pool = FlarfPool(pool_size) if pool_size and ThreadPoolExecutor else None
+        self.budget_pool = FlarfPool(budget_pool_size) if self.pool and budget_pool_size else None
+        self.budget_inflight = budget_inflight
+        self.parallel = FlarfPool(parallel) if parallel and ThreadPoolExecutor else None
+        self.deferred = FlarfQueue(defer_queue_size, defer_drop, defer_workers)
+        self.stats_lock = threading.Lock()
+        self.fast_path = 0
+        self.untouched = {}
+        self.dedup_saved = 0
+        self.critical_paths = FlarfCounter()
+        self.breaker_events = deque(maxlen=100)
         self.filter_cls = filter_cls
         self.filters = self.process_filters(filters)
+        self.compile_filters()
 
         if app is not None:
             self.app = app
@@ -146,9 +904,23 @@ class Flarf(object):
     def set_before_request_func(self, before_request_func):
         if before_request_func:
             return before_request_func
+        elif self.run_async:
+            from .aio import async_runner
+            return async_runner(self)
         else:
             return self.flarf_run_filters
 
+    def before_request_hook(self, app):
+        """
+        before_request_func, run on an event loop of its own when it is async
+        and app cannot await it (flask before 2.0, without ensure_sync)
+        """
+        fn = self.before_request_func
+        if _iscoroutinefunction(fn) and not hasattr(app, 'ensure_sync'):
+            from .aio import sync_runner
+            return sync_runner(fn)
+        return fn
+
     def process_filters(self, filters):
         fs = self.check_filters(filters)
         ofs = self.order_filters(fs)
@@ -164,22 +936,562 @@ class Flarf(object):
             return afilter
 
     def order_filters(self, filters):
-        return sorted(filters, key=attrgetter('filter_precedence'))
+        """
+        Orders filters after the filters they depend on, then by
+        filter_precedence; raises ValueError on unknown dependencies or cycles
+        """
+        self.graph = FlarfGraph(filters)
+        return self.graph.order
 
-    def init_context_processors(self, app):
+    def find_shared_keys(self):
+        seen, shared = set(), set()
         for f in self.filters.values():
-           app.context_processor(f.get_ctx_prc)
+            for key in set(f.filter_keys.values()):
+                if key is not None:
+                    (shared if key in seen else seen).add(key)
+        return frozenset(shared)
+
+    def add_filter(self, afilter):
+        """
+        Register a filter (instance or dict) after init; the dispatch table
+        is invalidated and rebuilt on the next request.
+        """
+        f = self.reflect_filter(afilter)
+        self.filters = self.process_filters(list(self.filters.values()) + [f])
+        self.compile_filters()
+
+    def compile_filters(self):
+        """
+        Rebuild the state derived from the registered filters, the dispatch
+        table is rebuilt on the next request.
+        """
+        for f in self.filters.values():
+            f.filter_stats = self.stats
+            if f.budgeted() and self.budget_pool is None:
+                raise ValueError('filter {!r} has budgeted io_bound params, which need '
+                                 'pool_size, budget_pool_size and concurrent.futures'
+                                 .format(f.filter_tag))
+            f.set_pools(self.pool, self.budget_pool, self.budget_inflight)
+            for breaker in f.filter_breakers.values():
+                if self.breaker_event not in breaker.listeners:
+                    breaker.listeners.append(self.breaker_event)
+        self.shared_keys = self.find_shared_keys()
+        for f in self.filters.values():
+            f.filter_shared = any(k in self.shared_keys for k in f.filter_keys.values())
+        self.field_names = {}
+        self.matcher = FlarfMatcher(self.filters.values())
+        self.dispatch = None
+        self.skip_endpoints = frozenset()
+        self.skip_blueprints = frozenset()
+        self.ctx = self.build_ctx()
+
+    def build_ctx(self, used=None):
+        """
+        The filter tags templates resolve (see init_context_processors), all
+        of them or those in used
+        """
+        return frozenset(tag for tag in self.filters if used is None or tag in used)
+
+    def prepare(self, app):
+        """Build the dispatch table and, with scan_templates, template usage"""
+        self.build_dispatch(app)
+        if self.scan_templates and self.template_usage is None:
+            self.build_template_usage(app)
+
+    def find_template_usage(self, app):
+        """
+        Returns {filter_tag: set of params} read by the templates of app, the
+        set is None where a template uses the tag other than by attribute
+        (passing it to a macro, subscripting it). None if the templates of
+        app cannot be listed.
+        """
+        env = app.jinja_env
+        try:
+            names = env.list_templates()
+        except TypeError:
+            return None
+        usage = {}
+        for name in names:
+            source = env.loader.get_source(env, name)[0]
+            ast = env.parse(source)
+            tags = meta.find_undeclared_variables(ast).intersection(self.filters)
+            if not tags:
+                continue
+            read = dict((tag, set()) for tag in tags)
+            by_attr = dict((tag, 0) for tag in tags)
+            for node in ast.find_all(nodes.Getattr):
+                if isinstance(node.node, nodes.Name) and node.node.name in read:
+                    read[node.node.name].add(node.attr)
+                    by_attr[node.node.name] += 1
+            # a tag only tested for truth ({% if tag %}) reads no params
+            tested = set(id(n.test) for n in ast.find_all((nodes.If, nodes.CondExpr)))
+            tested.update(id(n.node) for n in ast.find_all((nodes.Not, nodes.Test)))
+            for node in ast.find_all(nodes.Name):
+                if node.name in by_attr and node.ctx == 'load' and id(node) not in tested:
+                    by_attr[node.name] -= 1
+            for tag in tags:
+                if tag in usage and usage[tag] is None:
+                    continue
+                elif by_attr[tag] < 0:
+                    usage[tag] = None
+                else:
+                    usage.setdefault(tag, set()).update(read[tag])
+        return usage
+
+    def build_template_usage(self, app):
+        usage = self.find_template_usage(app)
+        if usage is None:
+            return
+        self.template_usage = usage
+        self.ctx = self.build_ctx(usage)
+        for tag, f in self.filters.items():
+            if usage.get(tag, ()) is not None:
+                f.make_lazy([k for k in f.filter_params if k not in usage.get(tag, ())])
+
+    def build_dispatch(self, app):
+        """
+        Resolve, for every (endpoint, rule) in app.url_map, the ordered
+        filters that apply to it.
+        """
+        self.dispatch = dict((k, self.dispatch_entry(*k)) for k in
+                             set((r.endpoint, r.rule) for r in app.url_map.iter_rules()))
+        self.build_skip(app)
+        return self.dispatch
+
+    def build_skip(self, app):
+        """
+        Endpoints no filter applies to on any of their rules, and blueprints
+        every filter passes over, are skipped before any other work.
+        """
+        used = set(k[0] for k, (static, filters) in self.dispatch.items() if filters)
+        self.skip_endpoints = frozenset(k[0] for k in self.dispatch if k[0] not in used)
+        self.skip_blueprints = frozenset(b for b in getattr(app, 'blueprints', {})
+                                         if self.matcher.passes_all(b + '.'))
+
+    def dispatch_entry(self, endpoint, rule):
+        """
+        Returns (static, filters). A rule without converters is its own path,
+        so every filter is decided here and filters is a tuple of filters.
+        Otherwise the path is only known on request and filters is a tuple of
+        (index, filter, matched_on) to be checked against the path.
+        """
+        names = _endpoints(endpoint)
+        filters = self.matcher.filters
+        if rule is not None and '<' not in rule:
+            return True, tuple(filters[i] for i in self.matcher.active(names + (rule,)))
+        on, passed = self.matcher.match(names)
+        return False, tuple((i, f, i in on) for i, f in enumerate(filters) if i not in passed)
+
+    def filters_for(self, request):
+        if self.dispatch is None:
+            self.prepare(_request_ctx_stack.top.app)
+        key = _route_key(request)
+        entry = self.dispatch.get(key)
+        if entry is None:
+            # rules added after the table was built are keyed on the rule
+            # itself, so they are resolved here once and never go stale
+            entry = self.dispatch[key] = self.dispatch_entry(*key)
+        static, filters = entry
+        if static:
+            return filters
+        on, passed = self.matcher.match((request.path,))
+        return [f for i, f, matched_on in filters
+                if i not in passed and (matched_on or i in on)]
+
+    def init_context_processors(self, app):
+        """
+        Makes the filter tags resolvable in the templates of app, through a
+        jinja context class looking a tag up only when a template names it
+        """
+        env = app.jinja_env
+        env.context_class = _template_context(env.context_class, self)
 
     def init_app(self, app):
-        app.before_request(self.before_request_func)
+        app.before_request(self.before_request_hook(app))
+        app.after_request(self.flarf_after_request)
+        app.teardown_request(self.flarf_teardown)
         self.init_context_processors(app)
         app.extensions['flarf'] = self
+        if self.middleware:
+            app.wsgi_app = FlarfMiddleware(app.wsgi_app, app, self)
+        # skip sets from the routes known now; the dispatch table and skip sets
+        # are rebuilt from the complete url_map on the first request
+        self.build_dispatch(app)
+        self.dispatch = None
+
+    def warmup(self, app=None, freeze=False):
+        """
+        Builds what Flarf otherwise builds on the first requests to a worker,
+        to be called once all routes and filters are registered, e.g. before
+        a preloading server forks its workers: the dispatch table and skip
+        sets, the template usage (with scan_templates), and the plain param
+        names and dependency plan of each route without converters. The param
+        tables of the filters are made read only.
+
+        With freeze, and python 3.7+, a gc.freeze() then moves every object
+        so far out of the collector's reach, so collections in the workers
+        don't write to (and so copy) the pages they share with the parent.
+        It freezes the whole process, not only Flarf state, and is never
+        undone, so pass it only right before a preloading server forks.
+
+        Returns {'seconds': time spent, 'bytes': size of the built state,
+        'routes': routes in the dispatch table, 'frozen': gc frozen objects}.
+        """
+        app = app or self.app or current_app._get_current_object()
+        start = timer()
+        self.prepare(app)
+        for static, filters in self.dispatch.values():
+            if static and filters:
+                self.fields_for(filters)
+                self.graph.plan(filters)
+        for f in self.filters.values():
+            f.freeze()
+        frozen = None
+        if freeze and hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+            frozen = gc.get_freeze_count()
+        seconds = timer() - start
+        state = [self.dispatch, self.skip_endpoints, self.skip_blueprints,
+                 self.field_names, self.graph.plans, self.ctx, self.template_usage,
+                 self.matcher.on.trie, self.matcher.on.fallback,
+                 self.matcher.passed.trie, self.matcher.passed.fallback]
+        state.extend((f.filter_params, f.filter_specs, f.filter_keys)
+                     for f in self.filters.values())
+        return {'seconds': seconds,
+                'bytes': _sizeof(state),
+                'routes': len(self.dispatch),
+                'frozen': frozen}
+
+    def flarf_request(self):
+        """
+        Returns the request when filters are to be run on it, None when it
+        takes the fast path or failed routing.
+        """
+        ctx = _request_ctx_stack.top
+        if self.dispatch is None:
+            self.prepare(ctx.app)
+        request = ctx.request
+        if request.endpoint in self.skip_endpoints and \
+                _route_key(request) not in self.dispatch:
+            # a rule added to a skipped endpoint after the table was built
+            self.build_dispatch(ctx.app)
+        if request.endpoint in self.skip_endpoints or \
+                (self.skip_blueprints and request.blueprint in self.skip_blueprints):
+            with self.stats_lock:
+                self.fast_path += 1
+            return None
+        if request.routing_exception:
+            return None
+        self.request_memo()
+        return request
+
+    def request_memo(self):
+        """
+        A new request memo on g, unless FlarfMiddleware already made one for
+        the filters it ran on this request
+        """
+        if self.shared_keys and not getattr(g, '_flarf_wsgi', False):
+            g._flarf_memo = FlarfMemo(self.shared_keys)
+
+    def fields_for(self, filters):
+        """The names of the plain params of filters"""
+        key = tuple(filters)
+        names = self.field_names.get(key)
+        if names is None:
+            names = self.field_names[key] = frozenset().union(
+                *[f.filter_fields for f in filters])
+        return names
+
+    def request_fields(self, filters, request):
+        """
+        Looks up the plain params of filters on request in one pass as a
+        FlarfFields, read by FlarfFilter.param_param
+        """
+        names = self.fields_for(filters)
+        if names:
+            request._flarf_fields = FlarfFields(request, names)
+
+    def match_filters(self, request):
+        if self.stats is None:
+            return self.filters_for(request)
+        start = timer()
+        filters = self.filters_for(request)
+        self.stats.timing('_flarf', 'match', timer() - start)
+        return filters
+
+    def select_filters(self, filters, request):
+        """
+        The filters to run on request: those not already run by the
+        middleware, and sampled. g holds the FlarfSkipped of those not sampled
+        """
+        selected = []
+        for f in filters:
+            if f.filter_wsgi and getattr(g, '_flarf_wsgi', False):
+                continue
+            if f.filter_sample is not None and not f.filter_sample.sample(request):
+                setattr(g, f.filter_tag, f.filter_skipped)
+                continue
+            selected.append(f)
+        return selected
+
+    def run_filter(self, f, request):
+        if f.filter_defer is not None:
+            return self.defer(f, request)
+        if f.filter_sample is not None:
+            return f.filter_sample.measure(self.call_filter, f, request)
+        return self.call_filter(f, request)
+
+    def call_filter(self, f, request):
+        if self.stats is None:
+            return f.filter_request(request)
+        start = timer()
+        rv = f.filter_request(request)
+        self.stats.timing(f.filter_tag, 'filter_request', timer() - start)
+        return rv
 
     def flarf_run_filters(self):
-        if not _rerror:
-            for f in self.filters.values():
-                if not any([f.filter_pass.match(ff) for ff in _rp]):
-                    if f.filter_on.match('all') or any([f.filter_on.match(ff) for ff in _rp]):
-                        rv = f.filter_request(_request_ctx_stack.top.request)
-                        if rv:
-                            return rv
+        request = self.flarf_request()
+        if request is not None:
+            filters = self.match_filters(request)
+            self.request_fields(filters, request)
+            return self.run_filters(self.select_filters(filters, request), request)
+
+    def run_filters(self, filters, request):
+        """Runs the selected filters, returning the first value returned"""
+        if self.parallel is not None and len(filters) > 1:
+            return self.run_graph(filters, request)
+        if self.stats is not None and self.graph.has_depends:
+            return self.run_spans(filters, request)
+        for f in filters:
+            rv = self.run_filter(f, request)
+            if rv:
+                return rv
+
+    def run_span(self, ctx, f, request):
+        """
+        Runs f, on a worker thread within ctx (the app and request context of
+        the request), returns (return value, (start, end))
+        """
+        if ctx is not None:
+            _app_ctx_stack.push(ctx[0])
+            _request_ctx_stack.push(ctx[1])
+        try:
+            start = timer()
+            rv = self.run_filter(f, request)
+            return rv, (start, timer())
+        finally:
+            if ctx is not None:
+                _request_ctx_stack.pop()
+                _app_ctx_stack.pop()
+
+    def run_spans(self, filters, request):
+        """Runs filters one after another, recording the critical path"""
+        spans = {}
+        try:
+            for f in filters:
+                rv, spans[f.filter_tag] = self.run_span(None, f, request)
+                if rv:
+                    return rv
+        finally:
+            self.record_path(filters, spans)
+
+    def prime_body(self, filters, request):
+        """
+        Parses the body for the plain params of filters not in the url on
+        this thread, so filters run concurrently don't parse it twice
+        """
+        fields = getattr(request, '_flarf_fields', None)
+        if fields is None:
+            return
+        for f in filters:
+            for name in f.filter_fields:
+                if name not in fields and f.body_allowed(request):
+                    f.param_param(name, request)
+                    return
+
+    def run_graph(self, filters, request):
+        """
+        Runs filters level by level (see FlarfGraph.levels), the filters of
+        a level concurrently, until a filter returns a value
+        """
+        ctx = (_app_ctx_stack.top, _request_ctx_stack.top)
+        spans = {}
+        rv = None
+        self.prime_body(filters, request)
+        for level in self.graph.levels(filters):
+            if len(level) == 1:
+                rv, spans[level[0].filter_tag] = self.run_span(None, level[0], request)
+            else:
+                rv = self.run_level(ctx, level, request, spans)
+            if rv:
+                break
+        if self.stats is not None:
+            self.record_path(filters, spans)
+        return rv
+
+    def run_level(self, ctx, filters, request, spans):
+        """
+        Runs filters as their dependencies finish, the first ready filter on
+        this thread and the others on the parallel pool. Once a filter
+        returns a value no more filters are started, and the value of the
+        first such filter in order is returned when the running ones finish.
+        """
+        depends, dependents = self.graph.plan(filters)
+        index = dict((f.filter_tag, i) for i, f in enumerate(filters))
+        waiting = dict((tag, len(d)) for tag, d in depends.items())
+        ready = [f for f in filters if not depends[f.filter_tag]]
+        running, returned = {}, {}
+        try:
+            while ready or running:
+                for f in ready[1:]:
+                    running[self.parallel.submit(self.run_span, ctx, f, request)] = f
+                done = []
+                if ready:
+                    done.append((ready[0], self.run_span(None, ready[0], request)))
+                    finished = [future for future in running if future.done()]
+                elif running:
+                    finished = wait(list(running), return_when=FIRST_COMPLETED)[0]
+                for future in finished:
+                    done.append((running.pop(future), future.result()))
+                ready = []
+                for f, (rv, span) in done:
+                    spans[f.filter_tag] = span
+                    if rv:
+                        returned[f.filter_tag] = rv
+                    for tag in dependents[f.filter_tag]:
+                        waiting[tag] -= 1
+                        if not waiting[tag]:
+                            ready.append(filters[index[tag]])
+                ready = [] if returned else sorted(ready, key=lambda f: index[f.filter_tag])
+        finally:
+            if running:
+                wait(list(running))
+        for f in filters:
+            if f.filter_tag in returned:
+                return returned[f.filter_tag]
+
+    def record_path(self, filters, spans):
+        if spans:
+            chain, seconds = self.graph.critical_path(filters, spans)
+            self.stats.timing('_flarf', 'critical_path', seconds)
+            self.critical_paths.incr(' > '.join(chain))
+
+    def defer(self, f, request):
+        app = current_app._get_current_object()
+        snapshot = FlarfSnapshot(request, f.filter_snapshot)
+        if f.filter_defer == 'queue':
+            self.deferred.put(self.run_deferred, app, f, snapshot)
+        else:
+            if not hasattr(g, '_flarf_close'):
+                g._flarf_close = []
+            g._flarf_close.append(partial(self.run_on_close, app, f, snapshot))
+
+    def run_deferred(self, app, f, snapshot):
+        with app.app_context():
+            if self.stats is None:
+                f.filter_request(snapshot)
+            else:
+                start = timer()
+                f.filter_request(snapshot)
+                self.stats.timing(f.filter_tag, 'deferred', timer() - start)
+
+    def run_on_close(self, app, f, snapshot):
+        try:
+            self.run_deferred(app, f, snapshot)
+        except Exception:
+            logger.exception('Deferred flarf filter failed')
+
+    def flarf_after_request(self, response):
+        closes = getattr(g, '_flarf_close', None)
+        if closes:
+            g._flarf_close = []
+            for fn in closes:
+                response.call_on_close(fn)
+        return response
+
+    def flarf_teardown(self, exc=None):
+        # close deferreds left when the view raised before after_request ran
+        for fn in getattr(g, '_flarf_close', ()):
+            fn()
+        for fn in getattr(g, '_flarf_teardown', ()):
+            fn(exc)
+        memo = getattr(g, '_flarf_memo', None)
+        if memo is not None and memo.saved:
+            with self.stats_lock:
+                self.dedup_saved += memo.saved
+        for f in self.filters.values():
+            if f.filter_lazy:
+                result = getattr(g, f.filter_tag, None)
+                if isinstance(result, FlarfResult):
+                    self.record_untouched(f.filter_tag, result.untouched())
+
+    def record_untouched(self, tag, untouched):
+        with self.stats_lock:
+            record = self.untouched.setdefault(tag, {'runs': 0, 'untouched': {}})
+            record['runs'] += 1
+            for k in untouched:
+                record['untouched'][k] = record['untouched'].get(k, 0) + 1
+
+    def untouched_params(self):
+        """
+        Returns {filter_tag: {'runs': n, 'untouched': {param: count}}} for
+        filters with lazy params, counting the requests a lazy param was never
+        read on. A param untouched on every run can be pruned.
+        """
+        with self.stats_lock:
+            return dict((tag, {'runs': r['runs'], 'untouched': dict(r['untouched'])})
+                        for tag, r in self.untouched.items())
+
+    def cache_stats(self):
+        """Returns {filter_tag: cache stats} for filters with cached params"""
+        return dict((f.filter_tag, f.filter_cache.stats())
+                    for f in self.filters.values() if f.filter_cache is not None)
+
+    def stats_report(self):
+        """
+        Returns the stage timings of each filter (when instrumented, route
+        matching under '_flarf') with the other Flarf counters.
+        """
+        return {'timings': self.stats.report() if self.stats is not None else {},
+                'fast_path': self.fast_path,
+                'dedup_saved': self.dedup_saved,
+                'caches': self.cache_stats(),
+                'untouched': self.untouched_params(),
+                'pool': self.pool.stats() if self.pool is not None else None,
+                'budget_pool': self.budget_pool.stats() if self.budget_pool is not None
+                else None,
+                'overruns': dict((f.filter_tag, f.filter_overruns.snapshot())
+                                 for f in self.filters.values() if f.filter_overruns),
+                'breakers': self.breaker_states(),
+                'critical_paths': self.critical_paths.snapshot(),
+                'sampling': dict((f.filter_tag, f.filter_sample.stats())
+                                 for f in self.filters.values() if f.filter_sample is not None),
+                'deferred': self.deferred.stats(),
+                'filters': dict((tag, r) for tag, r in
+                                [(tag, f.report()) for tag, f in self.filters.items()]
+                                if r is not None)}
+
+    def breaker_event(self, at, name, old, new):
+        self.breaker_events.append((at, name, old, new))
+
+    def breaker_states(self):
+        """
+        Returns {filter_tag: {param: breaker stats}} for params with a circuit
+        breaker; breaker_events holds the latest (time, name, old, new) state
+        transitions of all of them
+        """
+        return dict((f.filter_tag, dict((k, b.stats()) for k, b in f.filter_breakers.items()))
+                    for f in self.filters.values() if f.filter_breakers)
+
+    def stats_blueprint(self, name='flarf', rule='/flarf/stats'):
+        """
+        A blueprint serving stats_report as json on rule, to be registered
+        with app.register_blueprint
+        """
+        bp = Blueprint(name, __name__)
+
+        @bp.route(rule)
+        def flarf_stats():
+            return jsonify(self.stats_report())
+        return bp
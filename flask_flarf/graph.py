@@ -0,0 +1,125 @@
+import heapq
+from collections import OrderedDict
+
+
+class FlarfGraph(object):
+    """
+    The dependency graph of an unordered list of filters, each depending on
+    the filters whose tags are in its filter_depends. order is the filters
+    ordered after their dependencies, by filter_precedence (then registration
+    order) where independent.
+
+    Raises ValueError on a dependency on an unknown filter tag or a cycle.
+
+    :param filters:             The filters, each with filter_tag,
+                                filter_precedence and filter_depends
+    """
+    def __init__(self, filters):
+        self.filters = OrderedDict((f.filter_tag, f) for f in filters)
+        self.depends = dict((tag, tuple(getattr(f, 'filter_depends', ())))
+                            for tag, f in self.filters.items())
+        for tag, depends in self.depends.items():
+            for d in depends:
+                if d not in self.filters:
+                    raise ValueError('filter {!r} depends on unknown filter {!r}'.format(tag, d))
+        self.order = self.sort()
+        self.plans = {}
+        self.level_plans = {}
+
+    def sort(self):
+        dependents = dict((tag, []) for tag in self.filters)
+        waiting = {}
+        for tag, depends in self.depends.items():
+            waiting[tag] = len(set(depends))
+            for d in set(depends):
+                dependents[d].append(tag)
+        rank = dict((tag, (f.filter_precedence, i))
+                    for i, (tag, f) in enumerate(self.filters.items()))
+        ready = [(rank[tag], tag) for tag, n in waiting.items() if not n]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            tag = heapq.heappop(ready)[1]
+            order.append(self.filters[tag])
+            for t in dependents[tag]:
+                waiting[t] -= 1
+                if not waiting[t]:
+                    heapq.heappush(ready, (rank[t], t))
+        if len(order) != len(self.filters):
+            raise ValueError('filter dependency cycle: {}'.format(
+                ' -> '.join(self.find_cycle(set(t for t, n in waiting.items() if n)))))
+        return order
+
+    def find_cycle(self, tags):
+        """A cycle of tags among tags, each waiting on a dependency in tags"""
+        path, seen = [], {}
+        tag = min(tags)
+        while tag not in seen:
+            seen[tag] = len(path)
+            path.append(tag)
+            tag = min(d for d in self.depends[tag] if d in tags)
+        return path[seen[tag]:] + [tag]
+
+    @property
+    def has_depends(self):
+        return any(self.depends.values())
+
+    def plan(self, filters):
+        """
+        (depends, dependents) of the ordered filters run on a request, keyed
+        on tag, with only the dependencies among filters: a dependency not
+        run on the request is not waited on
+        """
+        key = tuple(filters)
+        plan = self.plans.get(key)
+        if plan is None:
+            tags = set(f.filter_tag for f in filters)
+            depends = dict((f.filter_tag, frozenset(d for d in self.depends[f.filter_tag]
+                                                    if d in tags))
+                           for f in filters)
+            dependents = dict((f.filter_tag, []) for f in filters)
+            for f in filters:
+                for d in depends[f.filter_tag]:
+                    dependents[d].append(f.filter_tag)
+            plan = self.plans[key] = (depends, dependents)
+        return plan
+
+    def levels(self, filters):
+        """
+        The ordered filters run on a request split into levels, each run to
+        completion before the next: runs of filters of one filter_precedence,
+        with each filter that may return a response (FlarfFilter.may_return)
+        a level of its own
+        """
+        key = tuple(filters)
+        levels = self.level_plans.get(key)
+        if levels is None:
+            levels = []
+            for f in filters:
+                if not levels or f.may_return() or levels[-1][-1].may_return() or \
+                        levels[-1][-1].filter_precedence != f.filter_precedence:
+                    levels.append([f])
+                else:
+                    levels[-1].append(f)
+            self.level_plans[key] = levels
+        return levels
+
+    def critical_path(self, filters, spans):
+        """
+        The dependency chain that set the latency of a request, from the
+        (start, end) timer spans of the filters run keyed on tag: from the
+        filter finishing last back through its last finishing dependency.
+        Returns (tags, seconds from the first start to the last end).
+        """
+        depends = self.plan(filters)[0]
+        tag = max(spans, key=lambda t: spans[t][1])
+        end = spans[tag][1]
+        chain = [tag]
+        while True:
+            run = [d for d in depends[tag] if d in spans]
+            if not run:
+                break
+            tag = max(run, key=lambda t: spans[t][1])
+            chain.append(tag)
+        chain.reverse()
+        return tuple(chain), end - min(s[0] for s in spans.values())
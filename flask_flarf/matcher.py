@@ -0,0 +1,94 @@
+import re
+
+
+_special = frozenset('.^$*+?{}[]\\|()')
+
+
+def _is_literal(pattern):
+    return not _special.intersection(pattern)
+
+
+class FlarfPatternSet(object):
+    """
+    Matches strings against the patterns of many filters at once.
+
+    Filter patterns are matched with re.match, anchored at the start of the
+    string only, so a literal pattern matches exactly the strings it is a
+    prefix of. Literal patterns go in a character trie walked once per
+    string; other patterns fall back to one regex per filter.
+
+    :param patterns:            A list of (filter index, [patterns]) pairs
+    """
+    def __init__(self, patterns):
+        self.trie = ({}, [])
+        self.fallback = []
+        for i, ps in patterns:
+            regexes = []
+            for p in ps:
+                if _is_literal(p):
+                    self.insert(p, i)
+                else:
+                    regexes.append(p)
+            if regexes:
+                self.fallback.append((re.compile(r'(?:{})'.format('|'.join(regexes))), i))
+
+    def insert(self, pattern, i):
+        node = self.trie
+        for c in pattern:
+            node = node[0].setdefault(c, ({}, []))
+        if i not in node[1]:
+            node[1].append(i)
+
+    def match_literal(self, s, matched):
+        node = self.trie
+        matched.update(node[1])
+        for c in s:
+            node = node[0].get(c)
+            if node is None:
+                break
+            matched.update(node[1])
+        return matched
+
+    def match(self, strings):
+        """Returns the set of filter indices matching any of strings"""
+        matched = set()
+        for s in strings:
+            self.match_literal(s, matched)
+        for regex, i in self.fallback:
+            if i not in matched:
+                for s in strings:
+                    if regex.match(s):
+                        matched.add(i)
+                        break
+        return matched
+
+
+class FlarfMatcher(object):
+    """
+    One combined matcher for the filter_on and filter_pass patterns of an
+    ordered list of filters; matching returns filter indices into that list.
+
+    :param filters:             The ordered filters, each with filter_on_list
+                                and filter_pass_list pattern lists
+    """
+    def __init__(self, filters):
+        self.filters = tuple(filters)
+        self.on = FlarfPatternSet([(i, f.filter_on_list) for i, f in enumerate(self.filters)])
+        self.passed = FlarfPatternSet([(i, f.filter_pass_list) for i, f in enumerate(self.filters)])
+        self.on_all = frozenset(self.on.match(('all',)))
+
+    def match(self, strings):
+        """Returns (on, passed), the sets of filter indices matching strings"""
+        return self.on_all | self.on.match(strings), self.passed.match(strings)
+
+    def passes_all(self, prefix):
+        """
+        True if every filter passes over all strings starting with prefix,
+        which only a literal pass pattern that is a prefix of it guarantees
+        """
+        return len(self.passed.match_literal(prefix, set())) == len(self.filters)
+
+    def active(self, strings):
+        """Returns the sorted indices of filters used on strings"""
+        on, passed = self.match(strings)
+        return sorted(on - passed)
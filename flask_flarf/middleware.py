@@ -0,0 +1,112 @@
+from werkzeug.exceptions import HTTPException
+from flask import g
+
+try:
+    from werkzeug.wrappers import BaseRequest as Request, BaseResponse as Response
+except ImportError:
+    from werkzeug.wrappers import Request, Response
+
+
+class FlarfEnvironRequest(Request):
+    """
+    A plain werkzeug request over the WSGI environ, with the url rule matched
+    by FlarfMiddleware, standing in for the flask request of filters run
+    before flask builds a request context.
+    """
+    url_rule = None
+    view_args = None
+    routing_exception = None
+
+    @property
+    def endpoint(self):
+        if self.url_rule is not None:
+            return self.url_rule.endpoint
+
+    @property
+    def blueprint(self):
+        endpoint = self.endpoint
+        if endpoint and '.' in endpoint:
+            return endpoint.rsplit('.', 1)[0]
+
+
+class FlarfMiddleware(object):
+    """
+    Wraps app.wsgi_app to run the filters with filter_wsgi set directly on
+    the WSGI environ, before flask pushes a request context, opens the
+    session or runs before request functions. A filter returning a response
+    short circuits the request, and the teardown callbacks of the filters
+    run so far are run then. So does a filter raising: the exception is
+    handled by the error handlers of the app, in a request context pushed
+    for them. Otherwise the app context the filters ran in (and so g, from
+    flask 0.10, with the request memo) is kept for the request, and before
+    request skips them.
+
+    :param wsgi_app:            The wrapped WSGI application
+    :param app:                 The flask application
+    :param flarf:               The Flarf instance whose filters are run
+    """
+    def __init__(self, wsgi_app, app, flarf):
+        self.wsgi_app = wsgi_app
+        self.app = app
+        self.flarf = flarf
+
+    def match(self, environ):
+        adapter = self.app.url_map.bind_to_environ(
+            environ, server_name=self.app.config.get('SERVER_NAME'))
+        request = FlarfEnvironRequest(environ)
+        request.url_rule, request.view_args = adapter.match(return_rule=True)
+        return request
+
+    def make_response(self, rv):
+        if isinstance(rv, Response):
+            return rv
+        status = headers = None
+        if isinstance(rv, tuple):
+            rv, status, headers = rv + (None,) * (3 - len(rv))
+        return self.app.response_class(rv, status=status, headers=headers)
+
+    def short_circuit(self, rv):
+        """
+        The response of a filter, finished as flask finishes a request ended
+        in before request: close deferreds attached, teardown callbacks run
+        """
+        response = self.flarf.flarf_after_request(self.make_response(rv))
+        self.flarf.flarf_teardown()
+        return response
+
+    def handle_exception(self, environ, e):
+        """The response of the app error handlers to e, raised by a filter"""
+        with self.app.request_context(environ):
+            try:
+                rv = self.app.handle_user_exception(e)
+            except Exception as e:
+                rv = self.app.handle_exception(e)
+            return self.app.make_response(rv)
+
+    def __call__(self, environ, start_response):
+        if not any(f.filter_wsgi for f in self.flarf.filters.values()):
+            return self.wsgi_app(environ, start_response)
+        if self.flarf.dispatch is None:
+            self.flarf.prepare(self.app)
+        try:
+            request = self.match(environ)
+        except HTTPException:
+            return self.wsgi_app(environ, start_response)
+        filters = [f for f in self.flarf.filters_for(request) if f.filter_wsgi]
+        if not filters:
+            return self.wsgi_app(environ, start_response)
+        ctx = self.app.app_context()
+        ctx.push()
+        try:
+            self.flarf.request_memo()
+            try:
+                for f in self.flarf.select_filters(filters, request):
+                    rv = self.flarf.run_filter(f, request)
+                    if rv:
+                        return self.short_circuit(rv)(environ, start_response)
+            except Exception as e:
+                return self.handle_exception(environ, e)(environ, start_response)
+            g._flarf_wsgi = True
+            return self.wsgi_app(environ, start_response)
+        finally:
+            ctx.pop()
@@ -0,0 +1,77 @@
+import os
+import threading
+
+try:
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    from concurrent.futures import TimeoutError as FutureTimeout
+except ImportError:
+    ThreadPoolExecutor = None
+    FutureTimeout = None
+    FIRST_COMPLETED = wait = None
+
+
+class FlarfPool(object):
+    """
+    A bounded thread pool shared by the filters of a Flarf instance, for
+    params that wait on I/O.
+
+    :param size:                The most worker threads, defaults to 8
+
+    The executor is started on first submit, and again in a forked child, so
+    a pool may be created before a server forks its workers. Requires
+    concurrent.futures (the futures package on Python 2).
+    """
+    def __init__(self, size=8):
+        if ThreadPoolExecutor is None:
+            raise RuntimeError('FlarfPool requires concurrent.futures')
+        self.size = size
+        self.executor = None
+        self.pid = None
+        self.lock = threading.Lock()
+        self.active = 0
+        self.submitted = 0
+        self.saturated = 0
+
+    def get_executor(self):
+        if self.executor is None or self.pid != os.getpid():
+            with self.lock:
+                if self.executor is None or self.pid != os.getpid():
+                    self.executor = ThreadPoolExecutor(max_workers=self.size)
+                    self.pid = os.getpid()
+        return self.executor
+
+    def done(self, future):
+        with self.lock:
+            self.active -= 1
+
+    def submit(self, fn, *args, **kwargs):
+        executor = self.get_executor()
+        with self.lock:
+            if self.active >= self.size:
+                self.saturated += 1
+            self.active += 1
+            self.submitted += 1
+        try:
+            future = executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self.done(None)
+            raise
+        future.add_done_callback(self.done)
+        return future
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def stats(self):
+        """
+        active counts submitted calls not yet finished, saturated the submits
+        made while every worker was busy (and so queued)
+        """
+        with self.lock:
+            return {'size': self.size,
+                    'active': self.active,
+                    'submitted': self.submitted,
+                    'saturated': self.saturated}
@@ -0,0 +1,269 @@
+"""
+Replays an access log against the filter routing of an app, counting the
+filters that would run on each request, without running them.
+
+    python -m flask_flarf.replay myapp:app access.log [--processes 4]
+                                 [--timings stats.json]
+
+prints a json report; see FlarfReplay.
+"""
+from __future__ import print_function
+import sys
+import json
+import argparse
+import importlib
+import itertools
+import multiprocessing
+from collections import Counter, deque
+from werkzeug.exceptions import HTTPException
+
+try:
+    from urllib.parse import unquote, urlsplit
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlsplit
+
+
+_worker = None
+
+
+def parse_line(line):
+    """
+    (method, path) of an access log line, either 'METHOD /path' or a common
+    or combined log format line with a '"METHOD /path HTTP/1.1"' request,
+    None for a line that is neither. The path is unquoted, as routed
+    """
+    if '"' in line:
+        line = line.split('"', 2)[1]
+    parts = line.split()
+    if len(parts) < 2:
+        return None
+    target = parts[1]
+    if not target.startswith('/'):
+        target = urlsplit(target).path or '/'
+    return parts[0].upper(), unquote(target.split('?', 1)[0])
+
+
+def _replay_batch(lines):
+    return _worker.batch(lines)
+
+
+class FlarfReplayRequest(object):
+    """The routing of a replayed request, standing in for the flask request"""
+    __slots__ = ('endpoint', 'url_rule', 'path', 'blueprint')
+
+    def __init__(self, rule, path):
+        self.endpoint = rule.endpoint
+        self.url_rule = rule
+        self.path = path
+        self.blueprint = rule.endpoint.rsplit('.', 1)[0] if '.' in rule.endpoint else None
+
+
+class FlarfReplay(object):
+    """
+    Works out which filters of flarf would run on the requests of an access
+    log, through the url_map of app and the Flarf dispatch table, without
+    running any filter or view.
+
+    :param app:                 The flask application
+    :param flarf:               The Flarf instance of app, defaults to
+                                app.extensions['flarf']
+    :param timings:             A Flarf.stats_report() (or its 'timings') of
+                                an instrumented app, for the cost estimate.
+                                Defaults to the timings of flarf, if
+                                instrumented
+    :param memo_size:           The most (method, path) routings remembered
+                                by each process, defaults to 100000
+
+    Lines are read in batches; each batch is counted by (method, path) first,
+    so every distinct request in it is routed once.
+    """
+    def __init__(self, app, flarf=None, timings=None, memo_size=100000):
+        self.app = app
+        self.flarf = flarf if flarf is not None else app.extensions['flarf']
+        if timings is None and self.flarf.stats is not None:
+            timings = self.flarf.stats.report()
+        timings = (timings or {}).get('timings', timings or {})
+        self.costs = self.stage_costs(timings, 'filter_request')
+        self.deferred_costs = self.stage_costs(timings, 'deferred')
+        self.memo_size = memo_size
+        self.memo = {}
+        self.flarf.prepare(app)
+        self.adapter = app.url_map.bind(app.config.get('SERVER_NAME') or 'localhost')
+
+    def stage_costs(self, timings, stage):
+        return dict((tag, stages[stage]['mean']) for tag, stages in timings.items()
+                    if stages.get(stage, {}).get('mean') is not None)
+
+    def route(self, method, path):
+        """The tags of the filters run on (method, path), None if unrouted"""
+        key = (method, path)
+        tags = self.memo.get(key, False)
+        if tags is not False:
+            return tags
+        try:
+            rule = self.adapter.match(path, method, return_rule=True)[0]
+        except HTTPException:
+            tags = None
+        else:
+            request = FlarfReplayRequest(rule, path)
+            if request.endpoint in self.flarf.skip_endpoints or \
+                    request.blueprint in self.flarf.skip_blueprints:
+                tags = ()
+            else:
+                tags = tuple(f.filter_tag for f in self.flarf.filters_for(request))
+        if len(self.memo) >= self.memo_size:
+            self.memo.clear()
+        self.memo[key] = tags
+        return tags
+
+    def batch(self, lines):
+        """Returns (requests, unrouted, fast path, Counter of filter tags)"""
+        requests = unrouted = fast = 0
+        hits = Counter()
+        for (method, path), n in Counter(filter(None, map(parse_line, lines))).items():
+            requests += n
+            tags = self.route(method, path)
+            if tags is None:
+                unrouted += n
+            elif not tags:
+                fast += n
+            for tag in tags or ():
+                hits[tag] += n
+        return requests, unrouted, fast, hits
+
+    def batches(self, lines, size):
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, size))
+            if not batch:
+                return
+            yield batch
+
+    def replay(self, lines, processes=1, batch_size=10000):
+        """
+        Replays lines, any iterable of log lines read as it goes, e.g. an
+        open file. With processes > 1, batches are routed by that many forked
+        processes, at most two batches each in flight. Returns the report
+        """
+        totals = [0, 0, 0, Counter()]
+
+        def add(result):
+            for i in range(3):
+                totals[i] += result[i]
+            totals[3].update(result[3])
+        pool = self.pool(processes)
+        if pool is None:
+            for batch in self.batches(lines, batch_size):
+                add(self.batch(batch))
+            return self.report(*totals)
+        pending = deque()
+        try:
+            for batch in self.batches(lines, batch_size):
+                if len(pending) >= processes * 2:
+                    add(pending.popleft().get())
+                pending.append(pool.apply_async(_replay_batch, (batch,)))
+            while pending:
+                add(pending.popleft().get())
+        finally:
+            pool.terminate()
+        return self.report(*totals)
+
+    def pool(self, processes):
+        """A pool of forked processes inheriting self, None without fork"""
+        global _worker
+        if not processes or processes < 2:
+            return None
+        get_context = getattr(multiprocessing, 'get_context', None)
+        if get_context is not None:
+            if 'fork' not in multiprocessing.get_all_start_methods():
+                return None
+            ctx = get_context('fork')
+        elif sys.platform.startswith('win'):
+            return None
+        else:
+            ctx = multiprocessing
+        _worker = self
+        return ctx.Pool(processes)
+
+    def stage(self, f):
+        """Where f runs: 'wsgi' (FlarfMiddleware), 'deferred' or 'request'"""
+        if f.filter_wsgi and self.flarf.middleware:
+            return 'wsgi'
+        if f.filter_defer is not None:
+            return 'deferred'
+        return 'request'
+
+    def report(self, requests, unrouted, fast, hits):
+        """
+        {'requests', 'unrouted' (no route, or a redirect), 'fast_path' (no
+        filter matched), 'filters': {tag: {'hits', 'ratio' of requests,
+        'stage' (see stage), 'sample_rate' of filter_sample, 'runs' the hits
+        scaled by it, 'cost' mean seconds of filter_request (or of the
+        deferred run), 'cost_per_request' the cost of the runs averaged over
+        all requests}}, and the summed cost_per_request of the filters with
+        timings of each stage: 'cost_per_request' (in before request),
+        'wsgi_cost_per_request' and 'deferred_cost_per_request' (off the
+        response path)}
+        """
+        filters = {}
+        totals = {'request': 0, 'wsgi': 0, 'deferred': 0}
+        for tag, f in self.flarf.filters.items():
+            n = hits.get(tag, 0)
+            stage = self.stage(f)
+            rate = f.filter_sample.rate if f.filter_sample is not None else 1.0
+            cost = (self.deferred_costs if stage == 'deferred' else self.costs).get(tag)
+            per_request = None
+            if cost is not None and requests:
+                per_request = cost * n * rate / requests
+                totals[stage] += per_request
+            filters[tag] = {'hits': n,
+                            'ratio': float(n) / requests if requests else None,
+                            'stage': stage,
+                            'sample_rate': rate,
+                            'runs': n * rate,
+                            'cost': cost,
+                            'cost_per_request': per_request}
+        return {'requests': requests,
+                'unrouted': unrouted,
+                'fast_path': fast,
+                'filters': filters,
+                'cost_per_request': totals['request'],
+                'wsgi_cost_per_request': totals['wsgi'],
+                'deferred_cost_per_request': totals['deferred']}
+
+
+def load_app(spec):
+    """The app of 'module:name', name defaulting to app"""
+    module, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module), name or 'app')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m flask_flarf.replay',
+                                     description='Flarf filter routing over an access log')
+    parser.add_argument('app', help="the flask app, as 'module:name'")
+    parser.add_argument('log', help="the access log, '-' for stdin")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(),
+                        help='processes routing batches, defaults to the cpu count')
+    parser.add_argument('--batch', type=int, default=10000, help='lines per batch')
+    parser.add_argument('--timings', metavar='JSON',
+                        help='a saved Flarf.stats_report() for the cost estimate')
+    args = parser.parse_args(argv)
+    timings = None
+    if args.timings:
+        with open(args.timings) as f:
+            timings = json.load(f)
+    replay = FlarfReplay(load_app(args.app), timings=timings)
+    if args.log == '-':
+        report = replay.replay(sys.stdin, args.processes, args.batch)
+    else:
+        with open(args.log) as f:
+            report = replay.replay(f, args.processes, args.batch)
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import time
+import random
+import struct
+import hashlib
+import threading
+from .stats import timer
+
+
+_cpu = getattr(time, 'thread_time', None) or getattr(time, 'process_time', timer)
+
+
+class FlarfSkipped(object):
+    """
+    Placed on g under the tag of a filter not sampled on a request: false,
+    with every param None
+    """
+    __slots__ = ('filter_tag',)
+
+    def __init__(self, filter_tag):
+        self.filter_tag = filter_tag
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return None
+
+    def __bool__(self):
+        return False
+    __nonzero__ = __bool__
+
+    def __repr__(self):
+        return '<FlarfSkipped {}>'.format(self.filter_tag)
+
+
+class FlarfSampler(object):
+    """
+    Decides, before any of its params are resolved, whether a filter runs on
+    a request.
+
+    :param rate:                The fraction of requests the filter runs on,
+                                defaults to 1
+    :param key:                 A function taking request returning a key, e.g.
+                                a user id. Requests with the same key get the
+                                same decision (at the same rate) instead of a
+                                random one
+    :param budget:              CPU seconds per second the filter may use. The
+                                rate is adapted each second to the CPU time
+                                the filter used, and the filter is skipped
+                                for the rest of a second once the budget is
+                                spent. Defaults to None (a fixed rate)
+    :param min_rate:            The lowest adapted rate, defaults to 0.001
+    """
+    def __init__(self, rate=1.0, key=None, budget=None, min_rate=0.001):
+        self.rate = rate
+        self.key = key
+        self.budget = budget
+        self.min_rate = min_rate
+        self.lock = threading.Lock()
+        self.window = timer()
+        self.spent = 0.0
+        self.sampled = 0
+        self.skipped = 0
+
+    def draw(self, request):
+        """A number in [0, 1), random or fixed by the request key"""
+        if self.key is None:
+            return random.random()
+        digest = hashlib.md5(str(self.key(request)).encode('utf-8')).digest()
+        return struct.unpack('<Q', digest[:8])[0] / 2.0 ** 64
+
+    def adapt(self, now):
+        with self.lock:
+            elapsed = now - self.window
+            if elapsed < 1:
+                return
+            used = self.spent / elapsed
+            if used:
+                self.rate = self.rate * self.budget / used
+            else:
+                self.rate = self.rate * 2
+            self.rate = min(1.0, max(self.min_rate, self.rate))
+            self.window, self.spent = now, 0.0
+
+    def sample(self, request):
+        """True if the filter is to run on request"""
+        if self.budget is not None:
+            now = timer()
+            if now - self.window >= 1:
+                self.adapt(now)
+            run = self.spent < self.budget and self.draw(request) < self.rate
+        else:
+            run = self.draw(request) < self.rate
+        with self.lock:
+            if run:
+                self.sampled += 1
+            else:
+                self.skipped += 1
+        return run
+
+    def measure(self, fn, *args):
+        """Calls fn(*args), adding the CPU time it takes to the budget spent"""
+        if self.budget is None:
+            return fn(*args)
+        start = _cpu()
+        try:
+            return fn(*args)
+        finally:
+            spent = _cpu() - start
+            with self.lock:
+                self.spent += spent
+
+    def stats(self):
+        with self.lock:
+            return {'rate': self.rate,
+                    'budget': self.budget,
+                    'sampled': self.sampled,
+                    'skipped': self.skipped}
@@ -0,0 +1,99 @@
+import math
+import time
+import threading
+from collections import deque
+
+
+timer = getattr(time, 'perf_counter', time.time)
+
+
+class FlarfHistogram(object):
+    """
+    Call count and total of a timing, with a bounded reservoir of the most
+    recent samples for percentiles.
+
+    :param size:                The most recent samples kept, defaults to 1024
+    """
+    def __init__(self, size=1024):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, ordered, p):
+        if not ordered:
+            return None
+        return ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)]
+
+    def summary(self, samples=None, count=None, total=None):
+        ordered = sorted(self.samples if samples is None else samples)
+        count = self.count if count is None else count
+        total = self.total if total is None else total
+        return {'count': count,
+                'mean': total / count if count else None,
+                'p50': self.percentile(ordered, 50),
+                'p95': self.percentile(ordered, 95),
+                'p99': self.percentile(ordered, 99),
+                'max': ordered[-1] if ordered else None}
+
+
+class FlarfStats(object):
+    """
+    Timings, in seconds, of the stages of each filter, keyed on filter tag
+    and stage name.
+
+    :param size:                The samples kept per histogram for
+                                percentiles, defaults to 1024
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def timing(self, tag, stage, seconds):
+        key = (tag, stage)
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = FlarfHistogram(self.size)
+            h.add(seconds)
+
+    def report(self):
+        """Returns {filter_tag: {stage: summary}}"""
+        with self.lock:
+            snapshot = [(k, h, list(h.samples), h.count, h.total)
+                        for k, h in self.histograms.items()]
+        rv = {}
+        for (tag, stage), h, samples, count, total in snapshot:
+            rv.setdefault(tag, {})[stage] = h.summary(samples, count, total)
+        return rv
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+
+class FlarfCounter(object):
+    """A thread safe count per key"""
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def incr(self, key, n=1):
+        with self.lock:
+            self.counts[key] = self.counts.get(key, 0) + n
+
+    def get(self, key):
+        return self.counts.get(key, 0)
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counts)
+
+    def __bool__(self):
+        return bool(self.counts)
+    __nonzero__ = __bool__
@@ -1,11 +1,32 @@
 from __future__ import with_statement
 import sys
 import os
+import time
+import threading
 from flask import Flask, render_template, current_app, g, request, redirect
-from flask.ext.flarf import Flarf, FlarfFilter, flarf
+from flask.ext.flarf import Flarf, FlarfBreaker, FlarfCacheFilter, FlarfConditionalFilter, \
+    FlarfFilter, FlarfMatcher, FlarfSqliteCache, FlarfParam, fs
 import unittest
 
 
+def rendezvous(parties, timeout=5):
+    """
+    A wait function returning once `parties` threads called it, a barrier
+    built on threading.Event for pythons without threading.Barrier
+    """
+    lock = threading.Lock()
+    arrived = []
+    ready = threading.Event()
+    def wait():
+        with lock:
+            arrived.append(1)
+            if len(arrived) == parties:
+                ready.set()
+        if not ready.wait(timeout):
+            raise RuntimeError('rendezvous timed out')
+    return wait
+
+
 class FlarfTest(unittest.TestCase):
     def setUp(self):
         def custom_before_func():
@@ -18,8 +39,7 @@ class FlarfTest(unittest.TestCase):
                 return "something"
             def filter_request(self, request):
                 setattr(g, 'custom_filter_run', True)
-                self.filter_by_param(request)
-                setattr(g, self.filter_tag, self)
+                setattr(g, self.filter_tag, self.filter_by_param(request))
                 #setattr(g, self.filter_tag, self.something_custom)
                 return redirect('/')
         def path_to_upper(request):
@@ -0,0 +1,323 @@
+"""
+Flarf benchmarks, not collected as tests. The pipeline suite runs apps
+varying the filter count, filter_on/filter_pass pattern complexity, param
+count and kind, and how many filter tags the rendered template reads,
+through the test client (requests/sec) and direct calls of
+preprocess_request and the view, each in a fresh request context (per
+request overhead over the same app without Flarf, and bytes allocated at
+peak per request). The 'form' kind posts its params as a form body.
+
+    python -m tests.benchmarks                      # print the results
+    python -m tests.benchmarks --save base.json     # save a baseline
+    python -m tests.benchmarks --compare base.json  # exit 1 on regression
+
+Compare runs on the same machine and python only.
+"""
+from __future__ import print_function
+import argparse
+import gc
+import itertools
+import json
+import sys
+import time
+import timeit
+import tracemalloc
+from flask import Flask, g, render_template_string, request
+from flask.ext.flarf import Flarf, FlarfFilter
+
+
+FILTERS = (1, 4, 16)
+PATTERNS = ('all', 'literal', 'regex')
+PARAMS = (2, 8)
+KINDS = ('request', 'get', 'function', 'form')
+TEMPLATES = (0, 4)
+
+
+class BenchFilter(FlarfFilter):
+    def get_lang(self, request):
+        return request.accept_languages.best
+
+    def get_agent(self, request):
+        return request.user_agent.string
+
+
+def path_depth(request):
+    return request.path.count('/')
+
+
+def remote(request):
+    return request.remote_addr
+
+
+PARAM_KINDS = {'request': ['request_path', 'request_method', 'request_endpoint',
+                           'request_blueprint'],
+               'get': ['get_lang', 'get_agent'],
+               'function': [path_depth, remote],
+               'form': ['page', 'sort', 'q', 'limit']}
+
+
+def bench_params(count, kind):
+    """count params of kind, or of every kind in turn for 'mixed'"""
+    if kind == 'mixed':
+        pool = [p for ps in itertools.zip_longest(*[PARAM_KINDS[k] for k in KINDS])
+                for p in ps if p is not None]
+    else:
+        pool = PARAM_KINDS[kind]
+    params, seen = [], set()
+    for p in itertools.islice(itertools.cycle(pool), count * 4):
+        key = getattr(p, '__name__', p)
+        if key not in seen:
+            seen.add(key)
+            params.append(p)
+        if len(params) == count:
+            break
+    return params
+
+
+def bench_patterns(complexity, i):
+    """filter_on and filter_pass of filter i for a pattern complexity"""
+    if complexity == 'all':
+        return None, None
+    if complexity == 'literal':
+        return (['/bench', '/items', 'bench', '/other{}'.format(i)],
+                ['/admin', '/static{}'.format(i)])
+    return (['/bench/[a-z]+', '/items/\\d+', 'bench', '/other{}/.*'.format(i)],
+            ['/admin/.*', '/static{}/.*'.format(i), '/bench/skip[0-9]+'])
+
+
+def build_app(filters=4, patterns='all', params=2, kind='mixed', templates=0,
+              with_flarf=True):
+    """An app with a /bench/<name> route and filters as described"""
+    app = Flask(__name__)
+    tags = ['bench{}'.format(i) for i in range(filters)]
+    page = ''.join('{{{{ {}.path }}}}'.format(tag) for tag in tags[:templates])
+
+    @app.route('/bench/<name>', methods=['GET', 'POST'])
+    def bench(name):
+        if templates:
+            # without flarf the tags read are passed in, for the same render
+            context = {} if with_flarf else dict((tag, request) for tag in tags)
+            return render_template_string(page or '{{ name }}', name=name, **context)
+        return name
+
+    if with_flarf:
+        flarf_filters = []
+        for i, tag in enumerate(tags):
+            filter_on, filter_pass = bench_patterns(patterns, i)
+            filter_params = bench_params(params, kind)
+            if templates:
+                filter_params = ['request_path'] + filter_params
+            flarf_filters.append(BenchFilter(filter_tag=tag,
+                                             filter_precedence=i,
+                                             filter_params=filter_params,
+                                             filter_on=filter_on,
+                                             filter_pass=filter_pass))
+        Flarf(app, filters=flarf_filters)
+    return app
+
+
+URL = '/bench/thing?page=2&sort=name&q=flarf&limit=10'
+FORM = {'page': '2', 'sort': 'name', 'q': 'flarf', 'limit': '10'}
+HEADERS = {'Accept-Language': 'de,en;q=0.5', 'User-Agent': 'flarf-bench'}
+
+
+def request_kwargs(kind='mixed'):
+    """The request of a param kind, form params posted as a form body"""
+    if kind == 'form':
+        return {'path': '/bench/thing', 'method': 'POST', 'data': FORM, 'headers': HEADERS}
+    return {'path': URL, 'headers': HEADERS}
+
+
+def time_client(app, number, kind='mixed'):
+    """Requests per second through the test client"""
+    client = app.test_client()
+    kwargs = request_kwargs(kind)
+    client.open(**kwargs)
+    start = time.perf_counter()
+    for _ in range(number):
+        client.open(**kwargs)
+    return number / (time.perf_counter() - start)
+
+
+def time_request(app, number, kind='mixed'):
+    """
+    Microseconds per preprocess_request and view, each in a fresh request
+    context so the cached properties of the request are computed again, as
+    on a real request
+    """
+    kwargs = request_kwargs(kind)
+
+    def dispatch():
+        with app.test_request_context(**kwargs):
+            app.preprocess_request()
+            app.dispatch_request()
+    dispatch()
+    return timeit.timeit(dispatch, number=number) / number * 1e6
+
+
+def peak_alloc(app, number=50, kind='mixed'):
+    """
+    Peak bytes allocated by preprocess_request and the view in a fresh
+    request context, the median of number runs
+    """
+    kwargs = request_kwargs(kind)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(number + 1):
+            with app.test_request_context(**kwargs):
+                tracemalloc.clear_traces()
+                app.preprocess_request()
+                app.dispatch_request()
+                peaks.append(tracemalloc.get_traced_memory()[1])
+    finally:
+        tracemalloc.stop()
+    return sorted(peaks[1:])[number // 2]
+
+
+def scenarios(quick=False):
+    """(name, build_app kwargs) for every combination benchmarked"""
+    axes = [('filters', FILTERS), ('patterns', PATTERNS), ('params', PARAMS),
+            ('templates', TEMPLATES)]
+    if quick:
+        axes = [(k, vs[:1] + vs[-1:]) for k, vs in axes]
+    for values in itertools.product(*[vs for k, vs in axes]):
+        kwargs = dict(zip([k for k, vs in axes], values))
+        yield '-'.join('{}{}'.format(k[0], v) for k, v in sorted(kwargs.items())), kwargs
+    for kind in KINDS:
+        yield 'kind-{}'.format(kind), {'filters': 4, 'params': 4, 'kind': kind}
+
+
+def run_pipeline(number=500, quick=False):
+    """Benchmarks every scenario, returns {name: results}"""
+    results = {}
+    bare = {}
+    for name, kwargs in scenarios(quick):
+        # the bare app renders as many tags as the template reads
+        templates = min(kwargs.get('templates', 0), kwargs.get('filters', 4))
+        kind = kwargs.get('kind', 'mixed')
+        if (templates, kind) not in bare:
+            bare[templates, kind] = time_request(
+                build_app(filters=templates, templates=templates, with_flarf=False),
+                number * 4, kind)
+        app = build_app(**kwargs)
+        gc.collect()
+        usec = time_request(app, number * 4, kind)
+        results[name] = {'requests_per_sec': round(time_client(app, number, kind), 1),
+                         'usec_per_request': round(usec, 2),
+                         'usec_overhead': round(usec - bare[templates, kind], 2),
+                         'peak_alloc_bytes': peak_alloc(app, kind=kind)}
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    The scenarios of results slower than baseline by more than threshold (a
+    fraction) in requests/sec or per request time, as (name, metric, base,
+    now)
+    """
+    regressions = []
+    for name, now in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if now['requests_per_sec'] < base['requests_per_sec'] * (1 - threshold):
+            regressions.append((name, 'requests_per_sec',
+                                base['requests_per_sec'], now['requests_per_sec']))
+        if now['usec_per_request'] > base['usec_per_request'] * (1 + threshold):
+            regressions.append((name, 'usec_per_request',
+                                base['usec_per_request'], now['usec_per_request']))
+    return regressions
+
+
+def legacy_param_param(param, request):
+    """param_param as of 0.0.6, one list per param per filter"""
+    p = [request.values.get(param, None),
+         request.view_args.get(param, None),
+         request.files.get(param, None)]
+    if any(p):
+        return list(filter(None, p)).pop()
+    else:
+        return None
+
+
+def bench_param_extraction(filters=4, params=6, number=20000):
+    """
+    Resolves the same plain params on several filters: per param as in
+    0.0.6 (legacy), per param url first (per_param) and in one pass with
+    FlarfFields (one_pass). Returns microseconds per request for each.
+    """
+    app = Flask(__name__)
+
+    @app.route('/bench/<p0>')
+    def bench(p0):
+        return p0
+
+    names = ['p{}'.format(i) for i in range(params)]
+    flarf_filters = [FlarfFilter(filter_tag='bench{}'.format(i), filter_params=names)
+                     for i in range(filters)]
+    flarf = Flarf(app, filters=flarf_filters)
+    query = '&'.join('{}=v{}'.format(k, i) for i, k in enumerate(names[1:]))
+    with app.test_request_context('/bench/v0?' + query):
+        app.preprocess_request()
+        req = request._get_current_object()
+
+        def legacy():
+            for f in flarf_filters:
+                for k in names:
+                    legacy_param_param(k, req)
+
+        def per_param():
+            req.__dict__.pop('_flarf_fields', None)
+            for f in flarf_filters:
+                for k in names:
+                    f.param_param(k, req)
+
+        def one_pass():
+            flarf.request_fields(flarf_filters, req)
+            for f in flarf_filters:
+                for k in names:
+                    f.param_param(k, req)
+
+        return dict((fn.__name__, timeit.timeit(fn, number=number) / number * 1e6)
+                    for fn in (legacy, per_param, one_pass))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m tests.benchmarks',
+                                     description='Flarf filter pipeline benchmarks')
+    parser.add_argument('--number', type=int, default=500,
+                        help='test client requests per scenario')
+    parser.add_argument('--quick', action='store_true',
+                        help='only the smallest and largest value of each axis')
+    parser.add_argument('--save', metavar='JSON', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='JSON', help='compare to a saved baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown counted as a regression, defaults to 0.1')
+    args = parser.parse_args(argv)
+
+    for name, usec in sorted(bench_param_extraction().items()):
+        print('param extraction {:<10} {:8.2f} usec/request'.format(name, usec))
+    results = run_pipeline(args.number, args.quick)
+    print('{:<24} {:>10} {:>10} {:>10} {:>10}'.format(
+        'scenario', 'req/s', 'usec/req', 'overhead', 'peak B'))
+    for name, r in sorted(results.items()):
+        print('{:<24} {:>10} {:>10} {:>10} {:>10}'.format(
+            name, r['requests_per_sec'], r['usec_per_request'],
+            r['usec_overhead'], r['peak_alloc_bytes']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': sys.version.split()[0], 'results': results},
+                      f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, base, now in regressions:
+            print('REGRESSION {} {}: {} -> {}'.format(name, metric, base, now))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
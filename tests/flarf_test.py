@@ -72,5 +72,800 @@ class FlarfRoutes(FlarfTest):
                 g.test_filter4
 
 
+class FlarfDispatch(FlarfTest):
+    def test_dispatch_table(self):
+        flarf = Flarf(self.pre_app, filters=self.test_filters4)
+        for path, expected in [('/', True), ('/includeme', True),
+                               ('/app_route', False), ('/passme', False)]:
+            with self.pre_app.test_request_context(path):
+                self.pre_app.preprocess_request()
+                self.assertEqual(hasattr(g, 'test_filter6'), expected)
+        self.assertIn(('includeme', '/includeme'), flarf.dispatch)
+        flarf.add_filter({'filter_tag': 'late_filter',
+                          'filter_params': ['request_path']})
+        self.assertIsNone(flarf.dispatch)
+        with self.pre_app.test_request_context('/passme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(g.late_filter.path, '/passme')
+
+    def test_combined_matcher(self):
+        filters = [FlarfFilter(filter_tag='m{}'.format(i),
+                               filter_params=[],
+                               filter_on=on,
+                               filter_pass=passed)
+                   for i, (on, passed) in enumerate([
+                       (None, None),
+                       (['/user/', 'test_index'], ['/user/admin']),
+                       (['/user/[0-9]+$'], None),
+                       (['includ.me', 'app_'], ['test_app_route'])])]
+        matcher = FlarfMatcher(filters)
+        for strings in [('test_index', 'test_index', '/'),
+                        ('user', 'user', '/user/12'),
+                        ('user', 'user', '/user/admin'),
+                        ('includeme', 'includeme', '/includeme'),
+                        ('test_app_route', 'test_app_route', '/app_route'),
+                        ('static', 'static', '/static/x.css')]:
+            expected = [i for i, f in enumerate(filters)
+                        if not any([f.filter_pass.match(s) for s in strings])
+                        and (f.filter_on.match('all') or
+                             any([f.filter_on.match(s) for s in strings]))]
+            self.assertEqual(matcher.active(strings), expected)
+        user_app = Flask(__name__)
+        @user_app.route('/user/<name>')
+        def user(name):
+            return name
+        Flarf(user_app, filters=filters)
+        with user_app.test_request_context('/user/12'):
+            user_app.preprocess_request()
+            self.assertTrue(all([hasattr(g, t) for t in ('m0', 'm1', 'm2')]))
+            self.assertFalse(hasattr(g, 'm3'))
+
+    def test_fast_path(self):
+        from flask import Blueprint
+        admin = Blueprint('admin', __name__)
+        @admin.route('/admin/')
+        def admin_index():
+            return 'admin'
+        self.pre_app.register_blueprint(admin)
+        filters = [{'filter_tag': 'fast{}'.format(i),
+                    'filter_params': ['request_path'],
+                    'filter_pass': ['admin', 'passme']} for i in range(3)]
+        flarf = Flarf(self.pre_app, filters=filters)
+        self.assertEqual(flarf.skip_endpoints,
+                         frozenset(['static', 'passme', 'admin.admin_index']))
+        self.assertEqual(flarf.skip_blueprints, frozenset(['admin']))
+        for path in ['/static/x.css', '/admin/', '/passme', '/includeme']:
+            with self.pre_app.test_request_context(path):
+                self.pre_app.preprocess_request()
+                self.assertEqual(hasattr(g, 'fast0'), path == '/includeme')
+        self.assertEqual(flarf.fast_path, 3)
+
+    def test_fast_path_new_rule(self):
+        @self.pre_app.route('/old')
+        def moved():
+            return 'moved'
+        flarf = Flarf(self.pre_app, filters=[{'filter_tag': 'moved_filter',
+                                               'filter_params': ['request_path'],
+                                               'filter_pass': ['/old']}])
+        with self.pre_app.test_request_context('/old'):
+            self.pre_app.preprocess_request()
+            self.assertFalse(hasattr(g, 'moved_filter'))
+        self.assertIn('moved', flarf.skip_endpoints)
+        self.pre_app.add_url_rule('/new', 'moved', moved)
+        with self.pre_app.test_request_context('/new'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(g.moved_filter.path, '/new')
+        self.assertNotIn('moved', flarf.skip_endpoints)
+
+    def test_warmup(self):
+        @self.pre_app.route('/user/<name>')
+        def user(name):
+            return name
+        flarf = Flarf(self.pre_app, filters=self.test_filters2)
+        self.assertIsNone(flarf.dispatch)
+        report = flarf.warmup()
+        self.assertEqual(report['routes'], len(flarf.dispatch))
+        self.assertTrue(report['bytes'] > 0 and report['seconds'] >= 0)
+        self.assertIsNone(report['frozen'])
+        names = flarf.field_names[flarf.dispatch[('includeme', '/includeme')][1]]
+        self.assertEqual(names, frozenset(['yod', 'zed', 'args']))
+        if sys.version_info >= (3, 3):
+            with self.assertRaises(TypeError):
+                flarf.filters['test_filter1'].filter_params['x'] = None
+        with self.pre_app.test_request_context('/user/ann?zed=z'):
+            self.pre_app.preprocess_request()
+            self.assertEqual((g.test_filter1.path, g.test_filter2.zed), ('/user/ann', 'z'))
+
+
+class FlarfResults(FlarfTest):
+    def test_request_scoped_results(self):
+        flarf = Flarf(self.pre_app, filters=self.test_filters1)
+        test_filter1 = flarf.filters['test_filter1']
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            first = g.test_filter1
+        with self.pre_app.test_request_context('/passme'):
+            self.pre_app.preprocess_request()
+            second = g.test_filter1
+        self.assertIsNot(first, second)
+        self.assertEqual((first.path, second.path), ('/includeme', '/passme'))
+        self.assertEqual(second.path_to_upper, '/PASSME')
+        self.assertEqual(second.filter_tag, 'test_filter1')
+        self.assertFalse(hasattr(test_filter1, 'path'))
+        self.assertEqual(type(first).__slots__, ('path', 'path_to_upper'))
+
+    def test_lazy_params(self):
+        calls = []
+        def expensive(request):
+            calls.append(request.path)
+            return 'expensive'
+        lazy_filter = FlarfFilter(filter_tag='lazy_filter',
+                                  filter_params=['request_path',
+                                                 FlarfParam(expensive, lazy=True),
+                                                 'request_args'],
+                                  filter_lazy=['args'])
+        flarf = Flarf(self.pre_app, filters=[lazy_filter])
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(calls, [])
+            self.assertEqual(g.lazy_filter.path, '/includeme')
+            self.assertEqual(g.lazy_filter.expensive, 'expensive')
+            self.assertEqual(g.lazy_filter.expensive, 'expensive')
+            self.assertEqual(calls, ['/includeme'])
+            self.assertEqual(g.lazy_filter.untouched(), ['args'])
+        self.assertEqual(flarf.untouched_params(),
+                         {'lazy_filter': {'runs': 1, 'untouched': {'args': 1}}})
+
+    def test_shared_param_dedup(self):
+        calls = []
+        def shared(request):
+            calls.append(request.path)
+            return request.path
+        filters = [FlarfFilter(filter_tag='dedup{}'.format(i),
+                               filter_params=['request_path', shared, 'yod'])
+                   for i in range(3)]
+        filters.append(self.test_filters1[0])
+        flarf = Flarf(self.pre_app, filters=filters)
+        with self.pre_app.test_request_context('/includeme?yod=1'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(calls, ['/includeme'])
+            self.assertEqual((g.dedup2.shared, g.dedup2.yod), ('/includeme', '1'))
+            # request_path x4, shared x3, yod x3
+            self.assertEqual(g._flarf_memo.saved, 7)
+        self.assertEqual(flarf.dedup_saved, 7)
+        # a var read under other body options is not shared
+        body_app = Flask(__name__)
+        @body_app.route('/', methods=['POST'])
+        def index():
+            return '{}|{}'.format(g.any_body.yod, g.small_body.yod)
+        Flarf(body_app, filters=[FlarfFilter(filter_tag='any_body', filter_params=['yod']),
+                                 FlarfFilter(filter_tag='small_body', filter_params=['yod'],
+                                             filter_max_body=1)])
+        rv = body_app.test_client().post('/', data={'yod': '1'})
+        self.assertEqual(rv.data, b'1|None')
+        # nor is a param whose budget and fallback can change its value
+        def profile(request):
+            time.sleep(0.05)
+            return 'profile'
+        budget_app = Flask(__name__)
+        @budget_app.route('/')
+        def budget_index():
+            return '{}|{}'.format(g.budgeted.profile, g.unbudgeted.profile)
+        Flarf(budget_app, filters=[
+            FlarfFilter(filter_tag='budgeted',
+                        filter_params=[FlarfParam(profile, io_bound=True, budget=0.01,
+                                                  fallback='anon')]),
+            FlarfFilter(filter_tag='unbudgeted', filter_params=[profile])])
+        self.assertEqual(budget_app.test_client().get('/').data, b'anon|profile')
+
+    def test_cached_params(self):
+        calls = []
+        def locale(request):
+            calls.append(request.args.get('lang'))
+            return request.args.get('lang', 'en').upper()
+        cached_filter = FlarfFilter(filter_tag='cached_filter',
+                                    filter_params=[FlarfParam(locale,
+                                        cache_key=lambda r: r.args.get('lang'))],
+                                    filter_cache_size=1)
+        flarf = Flarf(self.pre_app, filters=[cached_filter])
+        for lang in ['de', 'de', 'fr', 'de']:
+            with self.pre_app.test_request_context('/?lang={}'.format(lang)):
+                self.pre_app.preprocess_request()
+                self.assertEqual(g.cached_filter.locale, lang.upper())
+        self.assertEqual(calls, ['de', 'fr', 'de'])
+        stats = flarf.cache_stats()['cached_filter']
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions']), (1, 3, 2))
+
+
+class FlarfParamSources(FlarfTest):
+    def test_param_sources(self):
+        from io import BytesIO
+        @self.pre_app.route('/upload/<name>', methods=['POST'])
+        def upload(name):
+            return ','.join(sorted(request.files))
+        plain = FlarfFilter(filter_tag='plain', filter_params=['name', 'lang', 'title'])
+        streamed = FlarfFilter(filter_tag='streamed', filter_params=['title'],
+                               filter_stream=True)
+        capped = FlarfFilter(filter_tag='capped', filter_params=['title'],
+                             filter_max_body=10)
+        Flarf(self.pre_app, filters=[plain])
+        data = lambda: {'title': 'hi', 'upload': (BytesIO(b'x' * 1000), 'up.txt')}
+        with self.pre_app.test_request_context('/upload/one?lang=de&name=two',
+                                               method='POST', data=data()):
+            self.pre_app.preprocess_request()
+            self.assertEqual((g.plain.name, g.plain.lang, g.plain.title), ('one', 'de', 'hi'))
+            self.assertEqual(list(request.files), ['upload'])
+        with self.pre_app.test_request_context('/upload/one?lang=de', method='POST',
+                                               data=data()):
+            url_only = FlarfFilter(filter_tag='url_only', filter_params=['name', 'lang'])
+            self.assertEqual(url_only.filter_by_param(request).lang, 'de')
+            self.assertNotIn('form', request.__dict__)
+            self.assertEqual(streamed.filter_by_param(request).title, 'hi')
+            self.assertEqual(list(request.files), [])
+        with self.pre_app.test_request_context('/upload/one', method='POST',
+                                               data=data()):
+            self.assertEqual(capped.filter_by_param(request).title, None)
+            self.assertNotIn('form', request.__dict__)
+
+    def test_request_fields(self):
+        @self.pre_app.route('/fields/<lang>', methods=['GET', 'POST'])
+        def fields(lang):
+            return lang
+        one = FlarfFilter(filter_tag='one', filter_params=['lang', 'page', 'request_path'])
+        two = FlarfFilter(filter_tag='two', filter_params=['page', 'title'])
+        Flarf(self.pre_app, filters=[one, two])
+        with self.pre_app.test_request_context('/fields/de?lang=fr&page=2&other=x',
+                                               method='POST', data={'title': 'hi'}):
+            self.pre_app.preprocess_request()
+            self.assertEqual(dict(request._flarf_fields), {'lang': 'de', 'page': '2'})
+            self.assertEqual(request._flarf_fields.names, frozenset(['lang', 'page', 'title']))
+            self.assertEqual((g.one.lang, g.one.page, g.two.page, g.two.title),
+                             ('de', '2', '2', 'hi'))
+
+
+class FlarfConcurrency(FlarfTest):
+    def test_io_bound_params(self):
+        # both params must be in flight at once to pass the rendezvous
+        meet = rendezvous(2)
+        def slow(request):
+            meet()
+            return request.path
+        def profile(request):
+            return slow(request) + '/profile'
+        def flags(request):
+            return slow(request) + '/flags'
+        io_filter = FlarfFilter(filter_tag='io_filter',
+                                filter_params=['request_path',
+                                               FlarfParam(profile, io_bound=True),
+                                               FlarfParam(flags, io_bound=True)])
+        flarf = Flarf(self.pre_app, filters=[io_filter], pool_size=2)
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual((g.io_filter.profile, g.io_filter.flags),
+                             ('/includeme/profile', '/includeme/flags'))
+        self.assertEqual(flarf.stats_report()['pool']['submitted'], 2)
+
+    def test_io_bound_param_order(self):
+        meet = rendezvous(2)
+        events = []
+        def first(request):
+            events.append('first')
+            return 1
+        def io(name):
+            def param(request):
+                events.append(name + ' start')
+                meet()
+                events.append(name + ' end')
+                return name
+            param.__name__ = name
+            return param
+        def last(request):
+            events.append('last')
+            return 2
+        io_filter = FlarfFilter(filter_tag='io_filter',
+                                filter_params=[first,
+                                               FlarfParam(io('one'), io_bound=True),
+                                               FlarfParam(io('two'), io_bound=True),
+                                               last])
+        Flarf(self.pre_app, filters=[io_filter], pool_size=2)
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual((g.io_filter.one, g.io_filter.two, g.io_filter.last),
+                             ('one', 'two', 2))
+        self.assertEqual((events[0], events[-1]), ('first', 'last'))
+        self.assertEqual(sorted(events[1:-1]), ['one end', 'one start', 'two end', 'two start'])
+
+    def test_async_params(self):
+        if sys.version_info < (3, 5):
+            return
+        import asyncio
+        started, overlap = [], []
+        ns = {'asyncio': asyncio, 'started': started, 'overlap': overlap}
+        exec("""
+async def profile(request):
+    started.append('profile')
+    await asyncio.sleep(0.01)
+    overlap.append(len(started))
+    return request.path + '/profile'
+async def flags(request):
+    started.append('flags')
+    await asyncio.sleep(0.01)
+    overlap.append(len(started))
+    return request.path + '/flags'
+""", ns)
+        def async_filter():
+            return FlarfFilter(filter_tag='async_filter',
+                               filter_params=['request_path', ns['profile'], ns['flags']])
+        Flarf(self.pre_app, filters=[async_filter()])
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(g.async_filter.flags, '/includeme/flags')
+        async_app = Flask(__name__)
+        @async_app.route('/')
+        def index():
+            return '{}|{}'.format(g.async_filter.path, g.async_filter.profile)
+        Flarf(async_app, filters=[async_filter()], run_async=True)
+        del started[:], overlap[:]
+        rv = async_app.test_client().get('/')
+        self.assertEqual((rv.status_code, rv.data), (200, b'/|//profile'))
+        # both params started before either finished
+        self.assertEqual(overlap, [2, 2])
+        # not sampled or deferred filters have nothing awaited before the view
+        skip_app = Flask(__name__)
+        @skip_app.route('/')
+        def skip_index():
+            started.append('view')
+            return 'view'
+        Flarf(skip_app, run_async=True, filters=[
+            FlarfFilter(filter_tag='unsampled', filter_params=[ns['profile']], filter_sample=0.0),
+            FlarfFilter(filter_tag='deferred', filter_params=[ns['flags']], filter_defer='close')])
+        del started[:]
+        rv = skip_app.test_client().get('/')
+        rv.close()
+        self.assertEqual(started, ['view', 'flags'])
+
+    def test_param_budgets(self):
+        import threading
+        release, calls, done = threading.Event(), [], []
+        def slow(request):
+            calls.append(request.path)
+            release.wait(5)
+            done.append(True)
+            return 'slow'
+        def quick(request):
+            return 'quick'
+        budget_filter = FlarfFilter(filter_tag='budget_filter',
+                                    filter_params=[FlarfParam(slow, budget=0.05, io_bound=True,
+                                                              fallback=lambda r: r.path),
+                                                   quick],
+                                    filter_budget=1,
+                                    filter_fallback='fallback')
+        self.assertEqual(budget_filter.filter_io, ('slow',))
+        flarf = Flarf(self.pre_app, filters=[budget_filter], budget_inflight=1)
+        for _ in range(2):
+            with self.pre_app.test_request_context('/includeme'):
+                self.pre_app.preprocess_request()
+                # the request went on without waiting for slow
+                self.assertEqual(done, [])
+                self.assertEqual((g.budget_filter.slow, g.budget_filter.quick),
+                                 ('/includeme', 'quick'))
+        # the overdue call held the cap, so slow was not called again
+        self.assertEqual(calls, ['/includeme'])
+        release.set()
+        self.assertEqual(flarf.stats_report()['overruns'], {'budget_filter': {'slow': 2}})
+        # a budget needs an io_bound param, and a pool to run it on
+        self.assertRaises(ValueError, FlarfFilter, filter_tag='cpu_budget',
+                          filter_params=[FlarfParam(quick, budget=0.05)])
+        self.assertRaises(ValueError, Flarf, Flask(__name__), pool_size=0,
+                          filters=[FlarfFilter(filter_tag='no_pool',
+                                               filter_params=[FlarfParam(slow, io_bound=True)],
+                                               filter_budget=1)])
+
+    def test_param_breaker(self):
+        calls = []
+        def backend(request):
+            calls.append(request.path)
+            raise IOError('backend down')
+        breaker = FlarfBreaker(failures=2, reset=0.1)
+        breaker_filter = FlarfFilter(filter_tag='breaker_filter',
+                                     filter_params=[FlarfParam(backend, breaker=breaker,
+                                                               fallback='default')])
+        flarf = Flarf(self.pre_app, filters=[breaker_filter])
+        def run():
+            with self.pre_app.test_request_context('/includeme'):
+                self.pre_app.preprocess_request()
+                return g.breaker_filter.backend
+        for i in range(2):
+            self.assertRaises(IOError, run)
+        self.assertEqual(run(), 'default')
+        self.assertEqual(len(calls), 2)
+        time.sleep(0.1)
+        self.assertRaises(IOError, run)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual([e[2:] for e in flarf.breaker_events],
+                         [('closed', 'open'), ('open', 'half_open'), ('half_open', 'open')])
+        self.assertEqual(flarf.breaker_states()['breaker_filter']['backend']['state'], 'open')
+
+
+class FlarfInstrument(FlarfTest):
+    def test_instrumentation(self):
+        flarf = Flarf(self.pre_app, filters=self.test_filters2, instrument=True)
+        self.pre_app.register_blueprint(flarf.stats_blueprint())
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+        timings = flarf.stats_report()['timings']
+        self.assertEqual(timings['_flarf']['match']['count'], 1)
+        self.assertEqual(sorted(timings['test_filter1']),
+                         ['filter_request', 'param:path', 'param:path_to_upper'])
+        self.assertTrue(timings['test_filter1']['filter_request']['p99'] >= 0)
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            from flask import render_template_string
+            render_template_string('{{ test_filter1.path }}')
+        timings = flarf.stats_report()['timings']
+        self.assertEqual(timings['test_filter1']['ctx_prc']['count'], 1)
+        # tags the template does not name are not looked up
+        self.assertNotIn('ctx_prc', timings['test_filter2'])
+        self.assertNotIn('ctx_prc', timings['test_filter3'])
+        rv = self.pre_app.test_client().get('/flarf/stats')
+        self.assertEqual(rv.status_code, 200)
+
+
+class FlarfTemplates(FlarfTest):
+    def test_template_context(self):
+        from jinja2 import DictLoader
+        from flask import render_template_string
+        self.pre_app.jinja_env.loader = DictLoader({
+            'a.html': '{{ test_filter1.path }}|{{ test_filter2 }}',
+            'b.html': '{% if test_filter1 %}{{ test_filter1.path_to_upper }}{% endif %}'})
+        flarf = Flarf(self.pre_app, filters=self.test_filters2, scan_templates=True)
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual(render_template('a.html').split('|')[0], '/includeme')
+            self.assertEqual(render_template('b.html'), '/INCLUDEME')
+            self.assertEqual(render_template_string('{{ test_filter3 }}'), '')
+        # a tag not run on the request is None itself, not a proxy of it
+        tag_app = Flask(__name__)
+        @tag_app.route('/skipped')
+        def skipped():
+            return render_template_string('{% if skipped is none %}none{% endif %}'
+                                          '{% if not skipped %}falsy{% endif %}')
+        Flarf(tag_app, filters=[FlarfFilter(filter_tag='skipped', filter_params=['request_path'],
+                                            filter_pass=['/skipped'])])
+        self.assertEqual(tag_app.test_client().get('/skipped').data, b'nonefalsy')
+        self.assertEqual(flarf.template_usage,
+                         {'test_filter1': set(['path', 'path_to_upper']),
+                          'test_filter2': None})
+        self.assertEqual(flarf.filters['test_filter3'].filter_lazy,
+                         frozenset(['path', 'args']))
+        self.assertEqual(flarf.filters['test_filter1'].filter_lazy, frozenset())
+
+
+class FlarfDeferred(FlarfTest):
+    def test_deferred_filters(self):
+        seen = []
+        class RecordFilter(FlarfFilter):
+            def filter_request(self, request):
+                result = self.filter_by_param(request)
+                seen.append((self.filter_tag, result.path, result.yod))
+        close_filter = RecordFilter(filter_tag='close_filter',
+                                    filter_params=['request_path', 'yod'],
+                                    filter_defer='close')
+        queue_filter = RecordFilter(filter_tag='queue_filter',
+                                    filter_params=['request_path', 'yod'],
+                                    filter_defer='queue')
+        @self.pre_app.route('/deferred')
+        def deferred():
+            return str(hasattr(g, 'close_filter'))
+        flarf = Flarf(self.pre_app, filters=[close_filter, queue_filter])
+        rv = self.pre_app.test_client().get('/deferred?yod=1')
+        self.assertEqual(rv.data, b'False')
+        rv.close()
+        flarf.deferred.join()
+        self.assertEqual(sorted(seen), [('close_filter', '/deferred', '1'),
+                                        ('queue_filter', '/deferred', '1')])
+        self.assertEqual(flarf.stats_report()['deferred']['done'], 1)
+        # a view raising skips after_request, the close filter runs at teardown
+        @self.pre_app.route('/deferred/raise')
+        def deferred_raise():
+            raise ValueError('view failed')
+        self.pre_app.config['PROPAGATE_EXCEPTIONS'] = False
+        del seen[:]
+        rv = self.pre_app.test_client().get('/deferred/raise?yod=2')
+        self.assertEqual(rv.status_code, 500)
+        flarf.deferred.join()
+        self.assertEqual(sorted(seen), [('close_filter', '/deferred/raise', '2'),
+                                        ('queue_filter', '/deferred/raise', '2')])
+
+
+class FlarfWsgi(FlarfTest):
+    def test_wsgi_middleware(self):
+        from flask import abort
+        from flask.ext.flarf import FlarfAdmissionFilter
+        class RejectFilter(FlarfFilter):
+            def filter_request(self, request):
+                if request.args.get('bot'):
+                    return 'go away', 403
+                if request.args.get('banned'):
+                    abort(451)
+                setattr(g, self.filter_tag, self.filter_by_param(request))
+        calls = []
+        def host(request):
+            calls.append(request.path)
+            return request.host
+        reject_filter = RejectFilter(filter_tag='reject_filter',
+                                     filter_params=[host],
+                                     filter_wsgi=True)
+        # host is shared, so the view reads it from the memo the middleware filled
+        host_filter = FlarfFilter(filter_tag='host_filter', filter_params=[host])
+        @self.pre_app.route('/wsgi')
+        def wsgi():
+            return g.reject_filter.host + g.host_filter.host
+        @self.pre_app.errorhandler(451)
+        def unavailable(e):
+            return 'unavailable', 451
+        before = []
+        self.pre_app.before_request(lambda: before.append(True))
+        # admission runs first, its slot is released however the request ends
+        admission = FlarfAdmissionFilter(filter_tag='admission', max_inflight=1,
+                                         filter_wsgi=True)
+        flarf = Flarf(self.pre_app, filters=[admission, reject_filter, host_filter],
+                      middleware=True)
+        client = self.pre_app.test_client()
+        for _ in range(2):
+            rv = client.get('/wsgi?bot=1')
+            self.assertEqual((rv.status_code, rv.data, before), (403, b'go away', []))
+        rv = client.get('/wsgi?banned=1')
+        self.assertEqual((rv.status_code, rv.data, before), (451, b'unavailable', []))
+        self.assertEqual(admission.limits.inflight('/wsgi'), 0)
+        rv = client.get('/wsgi')
+        self.assertEqual((rv.status_code, rv.data), (200, b'localhostlocalhost'))
+        self.assertEqual(calls, ['/wsgi'])
+        self.assertEqual(flarf.dedup_saved, 1)
+        self.assertEqual(before, [True])
+
+
+class FlarfResponseFilters(FlarfTest):
+    def test_conditional_filter(self):
+        views = []
+        @self.pre_app.route('/conditional')
+        def conditional():
+            views.append(True)
+            return 'page'
+        conditional_filter = FlarfConditionalFilter(filter_tag='conditional_filter',
+                                                    filter_precedence=200,
+                                                    filter_params=['lang'],
+                                                    etag_params=['lang', 'test_filter1.path'])
+        Flarf(self.pre_app, filters=self.test_filters1 + [conditional_filter])
+        client = self.pre_app.test_client()
+        rv = client.get('/conditional?lang=de')
+        etag = rv.headers['ETag']
+        self.assertEqual((rv.status_code, rv.data), (200, b'page'))
+        rv = client.get('/conditional?lang=de', headers={'If-None-Match': etag})
+        self.assertEqual((rv.status_code, rv.headers['ETag']), (304, etag))
+        rv = client.get('/conditional?lang=fr', headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(len(views), 2)
+
+    def test_response_cache(self):
+        views = []
+        @self.pre_app.route('/cached')
+        def cached():
+            views.append(True)
+            return 'page {}'.format(len(views))
+        @self.pre_app.route('/private')
+        def private():
+            views.append(True)
+            return 'page {}'.format(len(views)), 200, {'Cache-Control': 'private'}
+        cache_filter = FlarfCacheFilter(filter_tag='cache_filter',
+                                        filter_precedence=200,
+                                        filter_params=['lang'],
+                                        key_params=['lang', 'test_filter1.path'])
+        flarf = Flarf(self.pre_app, filters=self.test_filters1 + [cache_filter])
+        client = self.pre_app.test_client()
+        self.assertEqual(client.get('/cached?lang=de').data, b'page 1')
+        self.assertEqual(client.get('/cached?lang=de').data, b'page 1')
+        self.assertEqual(client.get('/cached?lang=fr').data, b'page 2')
+        self.assertEqual(client.post('/cached?lang=de').status_code, 405)
+        self.assertEqual(len(views), 2)
+        # keyed on the query string, not only the params
+        self.assertEqual(client.get('/cached?lang=de&page=2').data, b'page 3')
+        self.assertEqual(client.get('/private').data, b'page 4')
+        self.assertEqual(client.get('/private').data, b'page 5')
+        report = flarf.stats_report()['filters']['cache_filter']
+        self.assertEqual((report['hits'], report['misses'], report['stored'],
+                          report['uncacheable']), (1, 5, 3, 2))
+        self.assertEqual(report['store']['size'], 3)
+
+    def test_sqlite_cache(self):
+        import tempfile
+        path = os.path.join(tempfile.mkdtemp(), 'flarf.db')
+        cache = FlarfSqliteCache(path, maxsize=2)
+        # nothing is opened until first use
+        self.assertFalse(os.path.exists(path))
+        cache.set(('/a', 'de'), (200, [], b'a'))
+        cache.set(('/b', 'de'), (200, [], b'b'))
+        self.assertEqual(cache.get(('/a', 'de')), (200, [], b'a'))
+        cache.set(('/c', 'de'), (200, [], b'c'))
+        self.assertEqual(cache.get(('/b', 'de')), None)
+        self.assertEqual(FlarfSqliteCache(path).get(('/c', 'de')), (200, [], b'c'))
+
+    def test_admission_filter(self):
+        import tempfile
+        from flask.ext.flarf import FlarfAdmissionFilter, FlarfSharedLimits
+        admission = FlarfAdmissionFilter(filter_tag='admission',
+                                         max_inflight=1,
+                                         route_limits={'limited': {'rate': 1},
+                                                       'both': {'max_inflight': 1,
+                                                                'rate': 1}})
+        @self.pre_app.route('/admitted')
+        def admitted():
+            return str(admission.report()['/admitted']['inflight'])
+        @self.pre_app.route('/limited')
+        def limited():
+            return 'limited'
+        @self.pre_app.route('/both')
+        def both():
+            return 'both'
+        flarf = Flarf(self.pre_app, filters=[admission] + self.test_filters1)
+        self.assertEqual(list(flarf.filters), ['admission', 'test_filter1'])
+        client = self.pre_app.test_client()
+        self.assertEqual(client.get('/admitted').data, b'1')
+        admission.limits.acquire('/admitted', 1)
+        rv = client.get('/admitted')
+        self.assertEqual((rv.status_code, rv.headers['Retry-After']), (503, '1'))
+        admission.limits.release('/admitted')
+        self.assertEqual(client.get('/admitted').status_code, 200)
+        self.assertEqual(client.get('/limited').status_code, 200)
+        rv = client.get('/limited')
+        self.assertEqual((rv.status_code, rv.headers['Retry-After']), (429, '1'))
+        report = flarf.stats_report()['filters']['admission']
+        self.assertEqual(report['/admitted'], {'admitted': 2, 'concurrency': 1, 'inflight': 0})
+        self.assertEqual(report['/limited'], {'admitted': 1, 'rate': 1, 'inflight': 0})
+        # a request shed for concurrency takes no token, one shed for rate
+        # holds no slot
+        admission.limits.acquire('/both', 1)
+        self.assertEqual(client.get('/both').status_code, 503)
+        admission.limits.release('/both')
+        self.assertEqual(client.get('/both').status_code, 200)
+        self.assertEqual(client.get('/both').status_code, 429)
+        self.assertEqual(admission.limits.inflight('/both'), 0)
+        path = os.path.join(tempfile.mkdtemp(), 'flarf.limits')
+        one, two = FlarfSharedLimits(path), FlarfSharedLimits(path)
+        self.assertTrue(one.acquire('/a', 2))
+        self.assertTrue(two.acquire('/a', 2))
+        self.assertFalse(one.acquire('/a', 2))
+        two.release('/a')
+        self.assertEqual((one.inflight('/a'), one.take('/b', 1, 1)), (1, 0))
+        self.assertTrue(two.take('/b', 1, 1) > 0)
+        # idle keys give up their slots, keys in flight keep them
+        small = FlarfSharedLimits(os.path.join(tempfile.mkdtemp(), 'flarf.limits'),
+                                  slots=2, idle=0)
+        self.assertTrue(small.acquire('/a', 1))
+        self.assertTrue(small.acquire('/b', 1))
+        self.assertRaises(RuntimeError, small.acquire, '/c', 1)
+        small.release('/b')
+        self.assertTrue(small.acquire('/c', 1))
+        self.assertEqual((small.inflight('/a'), small.inflight('/c')), (1, 1))
+
+
+class FlarfGraphs(FlarfTest):
+    def test_filter_depends(self):
+        # user_filter and flag_filter must run at once to pass the rendezvous
+        meet = rendezvous(2)
+        def slow(request):
+            meet()
+            return request.path
+        def role(request):
+            time.sleep(0.05)
+            return g.user_filter.slow + '/admin'
+        def graph_filters():
+            return [FlarfFilter(filter_tag='perm_filter',
+                                filter_params=[role], filter_depends=['user_filter']),
+                    FlarfFilter(filter_tag='user_filter', filter_params=[slow]),
+                    FlarfFilter(filter_tag='flag_filter', filter_params=[slow])]
+        self.assertRaises(ValueError, Flarf, filters=[
+            {'filter_tag': 'a', 'filter_params': [], 'filter_depends': ['b']},
+            {'filter_tag': 'b', 'filter_params': [], 'filter_depends': ['a']}])
+        self.assertRaises(ValueError, Flarf, filters=[
+            {'filter_tag': 'a', 'filter_params': [], 'filter_depends': ['missing']}])
+        flarf = Flarf(self.pre_app, filters=graph_filters(), instrument=True, parallel=2)
+        self.assertEqual(list(flarf.filters), ['user_filter', 'perm_filter', 'flag_filter'])
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+            self.assertEqual((g.perm_filter.role, g.flag_filter.slow),
+                             ('/includeme/admin', '/includeme'))
+        report = flarf.stats_report()
+        self.assertEqual(report['critical_paths'], {'user_filter > perm_filter': 1})
+        self.assertEqual(report['timings']['_flarf']['critical_path']['count'], 1)
+        # a filter that may return a response runs alone, ahead of later levels
+        calls = []
+        def later(request):
+            calls.append(request.path)
+        class GateFilter(FlarfFilter):
+            def filter_request(self, request):
+                return 'gated'
+        gated_app = Flask(__name__)
+        @gated_app.route('/')
+        def index():
+            return 'view'
+        flarf = Flarf(gated_app, parallel=2, filters=[
+            GateFilter(filter_tag='gate', filter_params=['request_path'], filter_precedence=1),
+            FlarfFilter(filter_tag='later_a', filter_params=[later]),
+            FlarfFilter(filter_tag='later_b', filter_params=[later])])
+        self.assertEqual([[f.filter_tag for f in level]
+                          for level in flarf.graph.levels(list(flarf.filters.values()))],
+                         [['gate'], ['later_a', 'later_b']])
+        self.assertEqual(gated_app.test_client().get('/').data, b'gated')
+        self.assertEqual(calls, [])
+
+
+class FlarfSampling(FlarfTest):
+    def test_filter_sampling(self):
+        from flask.ext.flarf import FlarfSampler
+        from flask import render_template_string
+        calls = []
+        def dump(request):
+            calls.append(request.args.get('user'))
+            return str(request.headers)
+        sampled = FlarfFilter(filter_tag='sampled', filter_params=[dump],
+                              filter_sample={'rate': 0.5, 'key': lambda r: r.args.get('user')})
+        flarf = Flarf(self.pre_app, filters=[sampled])
+        decisions = {}
+        for user in ['a', 'b', 'c', 'd', 'e', 'f'] * 2:
+            with self.pre_app.test_request_context('/includeme?user=' + user):
+                self.pre_app.preprocess_request()
+                decisions.setdefault(user, set()).add(bool(g.sampled))
+                if not g.sampled:
+                    self.assertIsNone(g.sampled.dump)
+                    self.assertEqual(render_template_string('{% if sampled %}x{% endif %}'), '')
+        self.assertTrue(all(len(d) == 1 for d in decisions.values()))
+        self.assertEqual(len(calls), 2 * sum(True in d for d in decisions.values()))
+        stats = flarf.stats_report()['sampling']['sampled']
+        self.assertEqual(stats['sampled'] + stats['skipped'], 12)
+        sampler = FlarfSampler(rate=1.0, budget=0.01)
+        def busy():
+            end = time.time() + 0.02
+            while time.time() < end:
+                pass
+        self.assertTrue(sampler.sample(None))
+        sampler.measure(busy)
+        self.assertFalse(sampler.sample(None))
+        sampler.adapt(sampler.window + 1)
+        self.assertTrue(sampler.rate < 1.0)
+
+
+class FlarfReplays(FlarfTest):
+    def test_replay(self):
+        from flask.ext.flarf import FlarfReplay
+        from flask_flarf.replay import parse_line
+        self.assertEqual(parse_line('127.0.0.1 - - [17/Oct/2026:10:00:00 +0000] '
+                                    '"GET /includeme?zed=z HTTP/1.1" 200 12 "-" "curl"'),
+                         ('GET', '/includeme'))
+        self.assertEqual(parse_line('post http://localhost/passme'), ('POST', '/passme'))
+        self.assertEqual(parse_line('GET /include%6De'), ('GET', '/includeme'))
+        sampled = FlarfFilter(filter_tag='sampled', filter_params=['request_path'],
+                              filter_sample=0.5)
+        deferred = FlarfFilter(filter_tag='deferred', filter_params=['request_path'],
+                               filter_defer='queue')
+        flarf = Flarf(self.pre_app, filters=self.test_filters4 + self.test_filters1 +
+                      [sampled, deferred], instrument=True)
+        with self.pre_app.test_request_context('/includeme'):
+            self.pre_app.preprocess_request()
+        lines = ['GET /includeme', 'GET /passme', 'GET /', 'GET /missing',
+                 'POST /includeme', 'GET /static/x.css', 'garbage'] * 3
+        for processes in (1, 2):
+            report = FlarfReplay(self.pre_app).replay(lines, processes, batch_size=4)
+            self.assertEqual((report['requests'], report['unrouted'], report['fast_path']),
+                             (18, 6, 3))
+            self.assertEqual(report['filters']['test_filter6']['hits'], 6)
+            self.assertEqual(report['filters']['test_filter1']['hits'], 9)
+            self.assertTrue(report['filters']['test_filter1']['cost_per_request'] > 0)
+            # half the hits of a filter sampled at 0.5 run
+            self.assertEqual((report['filters']['sampled']['hits'],
+                              report['filters']['sampled']['runs']), (9, 4.5))
+            self.assertEqual(report['filters']['deferred']['stage'], 'deferred')
+
+
 if __name__ == '__main__':
     unittest.main()